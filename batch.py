@@ -0,0 +1,162 @@
+"""
+Bulk offline batch mode - answer a JSONL file of questions concurrently.
+
+    python batch.py questions.jsonl answers.jsonl --concurrency 8
+
+Each input line is a JSON object; the question is read from "question" (or "body"/"title",
+so a requests.jsonl-style file works as-is) and the id from "id" (or "request_id", else the
+line number). Results stream to the output JSONL as they finish. Re-running with the same
+output file skips items that already have an "ok" result, so an interrupted run resumes.
+"""
+import argparse, json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from core import (
+    ConversationState,
+    run_turn,
+    enable_embedding_batching,
+    get_llm_cache_stats,
+    get_llm_limiter_stats
+)
+
+load_dotenv()
+
+QUESTION_FIELDS = ("question", "body", "title")
+ID_FIELDS = ("id", "request_id")
+
+
+def _first(item: dict, fields) -> str:
+    for field in fields:
+        if item.get(field):
+            return str(item[field])
+    return ""
+
+
+def read_items(input_path: str, question_field: str = None, id_field: str = None):
+    """Yield (item_id, question) pairs from a JSONL file"""
+    with open(input_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            item_id = _first(item, (id_field,) if id_field else ID_FIELDS) or str(line_number)
+            question = _first(item, (question_field,) if question_field else QUESTION_FIELDS)
+            yield item_id, question
+
+
+def completed_ids(output_path: str) -> set:
+    """Ids that already have a successful result in the output file"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of an interrupted run may be partial
+                continue
+            if result.get("status") == "ok":
+                done.add(result.get("id"))
+    return done
+
+
+def trim_partial_line(output_path: str):
+    """Cut off a partial last line left by an interrupted run, so appended results start on a
+    line of their own (that item has no result yet and is answered again)"""
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, "rb+") as f:
+        pos = f.seek(0, os.SEEK_END)
+        # Search back from the end, a block at a time, for the last newline
+        while pos > 0:
+            step = min(65536, pos)
+            f.seek(pos - step)
+            newline = f.read(step).rfind(b"\n")
+            if newline != -1:
+                f.truncate(pos - step + newline + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+
+def answer_one(item_id: str, question: str) -> dict:
+    """Run one question through the graph as a fresh, non-interactive session"""
+    start = time.perf_counter()
+    try:
+        result = run_turn(question, conversation=ConversationState(), interactive=False)
+        return {
+            "id": item_id,
+            "question": question,
+            "status": "ok",
+            "response": result["response"],
+            "agent_decision": result.get("agent_decision", ""),
+            "escalation_required": result.get("debug_info") == "escalation_required",
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+    except Exception as e:
+        return {
+            "id": item_id,
+            "question": question,
+            "status": "error",
+            "error": str(e),
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+
+
+def run_batch(input_path: str, output_path: str, concurrency: int = 8,
+              question_field: str = None, id_field: str = None) -> dict:
+    """Answer every pending question in input_path, appending results to output_path"""
+    enable_embedding_batching(max_batch=max(1, concurrency))
+    done = completed_ids(output_path)
+    trim_partial_line(output_path)
+    write_lock = threading.Lock()
+    # Caps queued work so thousands of items don't all sit in memory at once
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    summary = {"submitted": 0, "skipped": 0, "ok": 0, "error": 0}
+    start = time.perf_counter()
+
+    with open(output_path, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        def finish(future):
+            try:
+                result = future.result()
+                with write_lock:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                    summary[result["status"]] += 1
+            finally:
+                # Always given back - a failed write would otherwise block the submit loop for good
+                slots.release()
+
+        for item_id, question in read_items(input_path, question_field, id_field):
+            if item_id in done or not question:
+                summary["skipped"] += 1
+                continue
+            slots.acquire()
+            summary["submitted"] += 1
+            executor.submit(answer_one, item_id, question).add_done_callback(finish)
+
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    summary["llm_cache"] = get_llm_cache_stats()
+    summary["llm_limiter"] = get_llm_limiter_stats()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions with the support graph")
+    parser.add_argument("input", help="JSONL file of questions")
+    parser.add_argument("output", help="JSONL file to append results to (also used to resume)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--question-field", default=None)
+    parser.add_argument("--id-field", default=None)
+    args = parser.parse_args()
+
+    summary = run_batch(args.input, args.output, args.concurrency, args.question_field, args.id_field)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Pre-fork benchmark: memory per worker and embedding throughput vs worker count.
+
+    python benchmarks/prefork_scaling.py --requests 400
+
+For each worker count, starts a server.WorkerPool, drives raw embedding forward passes (no
+caches, no LLM or Supabase) through the workers, and reports throughput plus each worker's
+RSS, PSS and private memory. RSS counts the shared model pages in every worker; PSS splits
+them between the processes sharing them, so PSS x workers is what the pool really costs.
+"""
+import argparse, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from server import WorkerPool, memory_stats
+
+
+def run(workers: int, requests: int) -> dict:
+    pool = WorkerPool(workers)
+    pool.start()
+    try:
+        # Distinct texts so nothing can be served from a cache
+        texts = [f"How do I change the date of my event number {i}?" for i in range(requests)]
+
+        def embed(i: int):
+            return pool.submit(pool.workers[i % workers], "embed", texts[i])
+
+        with ThreadPoolExecutor(max_workers=workers * 2) as executor:
+            list(executor.map(embed, range(min(requests, workers * 4))))  # per-worker warm-up
+            start = time.perf_counter()
+            list(executor.map(embed, range(requests)))
+            elapsed = time.perf_counter() - start
+
+        per_worker = [memory_stats(worker.pid) for worker in pool.workers]
+    finally:
+        pool.stop()
+
+    def mean(key):
+        values = [stats.get(key, 0) for stats in per_worker]
+        return sum(values) / len(values) / 1024 if values else 0.0
+
+    return {
+        "workers": workers,
+        "throughput": requests / elapsed,
+        "rss_mb": mean("rss"),
+        "pss_mb": mean("pss"),
+        "private_mb": mean("private"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-fork memory and throughput scaling")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    counts, n = [], 1
+    while n < args.max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(args.max_workers)
+
+    parent = memory_stats(os.getpid())
+    print(f"Parent (model + graph loaded): RSS {parent.get('rss', 0) / 1024:.0f} MB")
+    print(f"{'workers':>7}  {'req/s':>8}  {'speedup':>7}  {'RSS/worker':>10}  {'PSS/worker':>10}  {'private/worker':>14}")
+    baseline = None
+    for workers in counts:
+        result = run(workers, args.requests)
+        baseline = baseline or result["throughput"]
+        print(f"{workers:>7}  {result['throughput']:>8.1f}  {result['throughput'] / baseline:>6.2f}x  "
+              f"{result['rss_mb']:>8.0f}MB  {result['pss_mb']:>8.0f}MB  {result['private_mb']:>12.0f}MB")
+
+
+if __name__ == "__main__":
+    main()
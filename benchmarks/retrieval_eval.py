@@ -0,0 +1,145 @@
+"""
+Retrieval eval: heading-aware parent sections vs the previous 500/40 fixed-size splitter.
+
+    python benchmarks/retrieval_eval.py                   # 3 LLM paraphrases per KB question
+    python benchmarks/retrieval_eval.py --save-questions q.jsonl   # ...and keep them for review
+    python benchmarks/retrieval_eval.py --questions q.jsonl --llm  # held-out question set
+
+The KB headings themselves are left out by default (--headings adds them): the section
+chunking puts each heading into every child chunk, so they'd score it on a near-exact match.
+
+Both chunkings of notion_export/ are indexed in memory with the production embedding model and
+searched by exact cosine; results go through the same _kb_answer as production (top 3, size
+cap, content check). Per strategy it reports:
+  found    - share of queries where _kb_answer accepts the context (otherwise: clarification)
+  hit      - share where the context contains the KB question the query was written for
+  answered - share the LLM answers rather than CANNOT_ANSWER_WITH_CONTEXT (--llm only)
+  prompt   - KB context characters sent to the LLM per found query (mean / p95)
+--questions takes JSON lines with "question" and "kb_key" ("<section>::<question heading>").
+"""
+import argparse, json, os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from loader import load_kb_sections, fixed_size_chunks, parent_child_chunks
+from core.memory import embeddings, _kb_answer
+from core.chunk_store import chunk_store
+from core.tools import answer_with_llm
+from warmup import kb_key, generate_question_variants
+
+CHILD_CANDIDATES = 24  # match_document_sections' candidate_count
+
+
+def _embed(texts: list[str]) -> np.ndarray:
+    return np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+
+def _row(row_id: str, doc, similarity: float) -> dict:
+    return {"id": row_id, "content": doc.page_content, "metadata": doc.metadata, "similarity": similarity}
+
+
+def fixed_search(chunks: list, matrix: np.ndarray):
+    def search(query_vec: np.ndarray) -> list[dict]:
+        sims = matrix @ query_vec
+        return [_row(f"fixed-{i}", chunks[i], float(sims[i])) for i in np.argsort(-sims)[:3]]
+    return search
+
+
+def section_search(parents: list, children: list, matrix: np.ndarray):
+    parents_by_id = {doc.id: doc for doc in parents}
+
+    def search(query_vec: np.ndarray) -> list[dict]:
+        # Same as match_document_sections: best children, one row per parent, parent returned
+        sims = matrix @ query_vec
+        best = {}
+        for i in np.argsort(-sims)[:CHILD_CANDIDATES]:
+            parent_id = children[i].metadata["parent_id"]
+            best.setdefault(parent_id, float(sims[i]))
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)[:3]
+        return [_row(parent_id, parents_by_id[parent_id], sim) for parent_id, sim in ranked]
+    return search
+
+
+def load_queries(docs: list, variants: int, questions_path: str, headings: bool = False) -> list[tuple[str, str]]:
+    if questions_path:
+        with open(questions_path) as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        return [(item["question"], item["kb_key"]) for item in items]
+    queries = []
+    for doc in docs:
+        heading = doc.metadata.get("question")
+        if heading and headings:
+            queries.append((heading, kb_key(doc)))
+        if variants:
+            queries.extend((q, kb_key(doc)) for q in generate_question_variants(doc, variants) if q != heading)
+    return queries
+
+
+def save_queries(queries: list, path: str):
+    with open(path, "w") as f:
+        for question, gold in queries:
+            f.write(json.dumps({"question": question, "kb_key": gold}) + "\n")
+
+
+def evaluate(name: str, search, queries: list, query_vecs: np.ndarray, use_llm: bool) -> dict:
+    found = hits = answered = 0
+    prompt_sizes = []
+    for (question, gold), query_vec in zip(queries, query_vecs):
+        result = _kb_answer(search(query_vec))
+        if not result.found:
+            continue
+        found += 1
+        docs = chunk_store.resolve(result.chunks)
+        hits += any(kb_key(doc) == gold for doc in docs)
+        # Same context string answer_node builds
+        context = f"From Knowledge Base: {' '.join([doc.page_content for doc in docs])}"
+        prompt_sizes.append(len(context))
+        if use_llm and answer_with_llm(question, context) != "CANNOT_ANSWER_WITH_CONTEXT":
+            answered += 1
+    total = len(queries) or 1
+    return {
+        "strategy": name,
+        "found": found / total,
+        "hit": hits / total,
+        "answered": answered / total if use_llm else None,
+        "prompt_mean": float(np.mean(prompt_sizes)) if prompt_sizes else 0.0,
+        "prompt_p95": float(np.percentile(prompt_sizes, 95)) if prompt_sizes else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parent-section vs fixed-size chunking retrieval eval")
+    parser.add_argument("--path", default="notion_export/")
+    parser.add_argument("--variants", type=int, default=3, help="LLM paraphrases per KB question")
+    parser.add_argument("--headings", action="store_true", help="Also use the KB headings as queries")
+    parser.add_argument("--questions", help="JSON lines with question and kb_key (held-out set)")
+    parser.add_argument("--save-questions", help="Write the generated queries here as JSON lines")
+    parser.add_argument("--llm", action="store_true", help="Also check answerability with answer_with_llm")
+    args = parser.parse_args()
+
+    docs = load_kb_sections(args.path)
+    fixed = fixed_size_chunks(docs)
+    parents, children = parent_child_chunks(docs)
+    queries = load_queries(docs, args.variants, args.questions, args.headings)
+    if args.save_questions:
+        save_queries(queries, args.save_questions)
+    print(f"{len(docs)} KB questions, {len(queries)} queries")
+    print(f"fixed: {len(fixed)} chunks; sections: {len(parents)} sections / {len(children)} child chunks")
+
+    query_vecs = _embed([question for question, _ in queries])
+    results = [
+        evaluate("fixed 500/40", fixed_search(fixed, _embed([d.page_content for d in fixed])),
+                 queries, query_vecs, args.llm),
+        evaluate("parent sections", section_search(parents, children, _embed([d.page_content for d in children])),
+                 queries, query_vecs, args.llm),
+    ]
+
+    print(f"\n{'strategy':<16}  {'found':>6}  {'hit':>6}  {'answered':>8}  {'prompt mean':>11}  {'prompt p95':>10}")
+    for r in results:
+        answered = f"{r['answered']:.1%}" if r["answered"] is not None else "-"
+        print(f"{r['strategy']:<16}  {r['found']:>6.1%}  {r['hit']:>6.1%}  {answered:>8}  "
+              f"{r['prompt_mean']:>9.0f}ch  {r['prompt_p95']:>8.0f}ch")
+
+
+if __name__ == "__main__":
+    main()
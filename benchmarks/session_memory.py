@@ -0,0 +1,149 @@
+"""
+Memory benchmark: per-session state for 10k concurrent sessions, before and after compact state.
+
+    python benchmarks/session_memory.py --sessions 10000
+
+"legacy" mirrors the old layout: un-slotted dataclasses, every session holding its own copy of
+the 3 retrieved KB Documents (fresh objects per RPC response) plus the memory row. "compact" is
+the current ConversationState: slots, ChunkRefs, and one shared copy of each chunk.
+Sessions awaiting a clarification reply (--awaiting, a fraction) also keep the first attempt's
+query embedding: a list of floats in the legacy layout, a float32 array in the compact one.
+Also reports checkpoint size (pickle of the legacy state vs ConversationState.to_checkpoint).
+"""
+import argparse, gc, importlib.util, json, os, pickle, random, tracemalloc
+from array import array
+from dataclasses import dataclass
+from typing import List
+
+# Loaded by path so the benchmark doesn't import core/__init__ (and load the embedding model)
+_spec = importlib.util.spec_from_file_location(
+    "core_models", os.path.join(os.path.dirname(__file__), "..", "core", "models.py"))
+models = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(models)
+
+KB_CHUNKS = 300          # distinct chunks in the KB
+CHUNK_CHARS = 500        # loader.py chunk size
+EMBEDDING_DIMS = 768     # all-mpnet-base-v2
+
+
+class Document:
+    """Stand-in for langchain's Document (pydantic model with a __dict__)"""
+    def __init__(self, page_content, metadata, id=None):
+        self.id = id
+        self.page_content = page_content
+        self.metadata = metadata
+
+
+@dataclass
+class LegacyConversationState:
+    original_question: str = ""
+    question: str = ""
+    answer: str = ""
+    qa_chunks: List = None
+    kb_chunks: List = None
+    qa_found: bool = False
+    kb_found: bool = False
+    escalation_needed: bool = False
+    email: str = ""
+    number: str = ""
+    issue_summary: str = ""
+    clarification_attempts: int = 0
+    query_embedding: List[float] = None
+
+
+def _kb_rows():
+    rnd = random.Random(0)
+    return [{
+        "id": f"{i:08x}-0000-0000-0000-000000000000",
+        "content": "".join(rnd.choice("abcdefghij klmnop") for _ in range(CHUNK_CHARS)),
+        "metadata": {"source": "notion_export/Knowledge base (customer support).md",
+                     "section": f"Section {i % 12}", "question": f"Question {i}?"},
+    } for i in range(KB_CHUNKS)]
+
+
+def _decoded(row: dict) -> dict:
+    # Every RPC response is freshly JSON-decoded, so each session gets new string objects
+    return json.loads(json.dumps(row))
+
+
+def _embedding(i: int) -> list:
+    rnd = random.Random(i)
+    return [rnd.uniform(-0.1, 0.1) for _ in range(EMBEDDING_DIMS)]
+
+
+def _awaiting(i: int, awaiting: float) -> bool:
+    # Spread evenly so the per-10k scaling holds for any --sessions
+    return int((i + 1) * awaiting) > int(i * awaiting)
+
+
+def build_legacy(sessions: int, rows: list, awaiting: float) -> list:
+    states = []
+    for i in range(sessions):
+        picked = [_decoded(rows[(i + k) % len(rows)]) for k in range(3)]
+        docs = [Document(r["content"], r["metadata"]) for r in picked]
+        memory_row = _decoded({"id": f"qa-{i}", "question": f"How do I do thing {i}?",
+                               "answer": picked[0]["content"][:300], "similarity": 0.91})
+        states.append(LegacyConversationState(
+            original_question=f"How do I do thing {i}?", question=f"How do I do thing {i}?",
+            qa_chunks=[memory_row], kb_chunks=docs, qa_found=True, kb_found=True,
+            query_embedding=_embedding(i) if _awaiting(i, awaiting) else None))
+    return states
+
+
+def build_compact(sessions: int, rows: list, awaiting: float) -> tuple:
+    store = {}
+    states = []
+    for i in range(sessions):
+        refs = []
+        for k in range(3):
+            row = rows[(i + k) % len(rows)]
+            ref_id = f"kb:{row['id']}"
+            if ref_id not in store:
+                store[ref_id] = Document(row["content"], row["metadata"], row["id"])
+            refs.append(models.ChunkRef(ref_id, 0.8))
+        # Memory rows for distinct questions are distinct, so they're still stored per answer
+        qa_id = f"qa:qa-{i % 2000}"
+        if qa_id not in store:
+            store[qa_id] = _decoded({"id": qa_id, "question": f"How do I do thing {i}?",
+                                     "answer": rows[i % len(rows)]["content"][:300], "similarity": 0.91})
+        states.append(models.ConversationState(
+            original_question=f"How do I do thing {i}?", question=f"How do I do thing {i}?",
+            qa_chunks=[models.ChunkRef(qa_id, 0.91)], kb_chunks=refs, qa_found=True, kb_found=True,
+            query_embedding=array("f", _embedding(i)) if _awaiting(i, awaiting) else None))
+    return states, store
+
+
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    result = build(*args)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--awaiting", type=float, default=0.1,
+                        help="Fraction of sessions waiting for a clarification reply")
+    args = parser.parse_args()
+    rows = _kb_rows()
+
+    legacy, legacy_bytes = measure(build_legacy, args.sessions, rows, args.awaiting)
+    (compact, store), compact_bytes = measure(build_compact, args.sessions, rows, args.awaiting)
+
+    legacy_ckpt = sum(len(pickle.dumps(s)) for s in legacy[:1000]) / 1000
+    compact_ckpt = sum(len(s.to_checkpoint().encode("utf-8")) for s in compact[:1000]) / 1000
+
+    per = 10000 / args.sessions
+    print(f"sessions: {args.sessions} ({args.awaiting:.0%} awaiting clarification)")
+    print(f"legacy  state memory per 10k sessions: {legacy_bytes * per / 1e6:8.2f} MB")
+    print(f"compact state memory per 10k sessions: {compact_bytes * per / 1e6:8.2f} MB "
+          f"(incl. {len(store)} shared chunks)")
+    print(f"legacy  checkpoint: {legacy_ckpt:8.0f} bytes/session (pickle)")
+    print(f"compact checkpoint: {compact_ckpt:8.0f} bytes/session (to_checkpoint)")
+
+
+if __name__ == "__main__":
+    main()
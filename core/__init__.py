@@ -1,5 +1,15 @@
 # Core modules for BeWhoop Support Agent
-from .memory import semantic_memory_lookup, semantic_memory_upsert, embeddings, search_knowledge_base_internal
+from .memory import (
+    semantic_memory_lookup,
+    semantic_memory_upsert,
+    semantic_memory_upsert_many,
+    embeddings,
+    search_knowledge_base_internal,
+    search_memory_and_kb,
+    encode_vector,
+    embed_query,
+    enable_embedding_batching
+)
 from .escalation import (
     create_support_ticket_legacy as create_support_ticket, 
     escalate_to_slack, 
@@ -15,19 +25,38 @@ from .tools import (
     is_waiting_for_clarification,
     make_agent_decision
 )
-from .models import Answer, ConversationState
+from .models import Answer, ConversationState, ChunkRef
+from .chunk_store import chunk_store
+from .llm_cache import CachedLLM, get_llm_cache_stats
+from .llm_limiter import LLMOverloadedError, get_llm_limiter_stats
+from .resilience import Deadline, DependencyUnavailableError, get_resilience_stats
+from .sections import classify_section, load_section_centroids
+from .retrieval_cache import bump_retrieval_version, get_retrieval_cache_stats
+from .profiling import (
+    profile_turn,
+    configure as configure_profiling,
+    get_settings as get_profiling_settings,
+    write_control_file as write_profiling_control
+)
 from .graph_nodes import (
     AgentState,
     set_conversation_state,
     process_with_langgraph,
-    create_support_graph
+    create_support_graph,
+    get_support_graph,
+    run_turn
 )
 
 __all__ = [
     'semantic_memory_lookup',
     'semantic_memory_upsert', 
+    'semantic_memory_upsert_many',
     'embeddings',
     'search_knowledge_base_internal',
+    'search_memory_and_kb',
+    'encode_vector',
+    'embed_query',
+    'enable_embedding_batching',
     'create_support_ticket',
     'escalate_to_slack',
     'handle_escalation_flow',
@@ -41,8 +70,27 @@ __all__ = [
     'make_agent_decision',
     'Answer',
     'ConversationState',
+    'ChunkRef',
+    'chunk_store',
+    'CachedLLM',
+    'get_llm_cache_stats',
+    'LLMOverloadedError',
+    'get_llm_limiter_stats',
+    'Deadline',
+    'DependencyUnavailableError',
+    'get_resilience_stats',
+    'classify_section',
+    'load_section_centroids',
+    'bump_retrieval_version',
+    'get_retrieval_cache_stats',
+    'profile_turn',
+    'configure_profiling',
+    'get_profiling_settings',
+    'write_profiling_control',
     'AgentState',
     'set_conversation_state',
     'process_with_langgraph',
-    'create_support_graph'
+    'create_support_graph',
+    'get_support_graph',
+    'run_turn'
 ] 
\ No newline at end of file
@@ -0,0 +1,42 @@
+"""
+Shared chunk store - retrieved KB documents and memory rows are kept once per process
+and referenced by id from graph and session state
+"""
+import os, threading
+from collections import OrderedDict
+
+CHUNK_STORE_MAX_ENTRIES = int(os.getenv("CHUNK_STORE_MAX_ENTRIES", "20000"))
+
+
+class ChunkStore:
+    """Thread-safe LRU of chunk id -> Document (KB) or row dict (memory)"""
+
+    def __init__(self, max_entries: int = CHUNK_STORE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, chunk_id: str, chunk):
+        with self._lock:
+            self._items[chunk_id] = chunk
+            self._items.move_to_end(chunk_id)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def get(self, chunk_id: str):
+        with self._lock:
+            chunk = self._items.get(chunk_id)
+            if chunk is not None:
+                self._items.move_to_end(chunk_id)
+            return chunk
+
+    def resolve(self, refs: list) -> list:
+        """Chunks for a list of ChunkRefs, skipping any that have been evicted"""
+        chunks = [self.get(ref.id) for ref in refs]
+        return [chunk for chunk in chunks if chunk is not None]
+
+    def __len__(self):
+        return len(self._items)
+
+
+chunk_store = ChunkStore()
@@ -0,0 +1,84 @@
+"""
+Shared embedding batcher and cache - concurrent turns share one model forward pass
+"""
+import os, threading, queue
+from array import array
+from collections import OrderedDict
+
+# Entries are float32 arrays (~3 KB for 768 dims), private to each worker process
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "2000"))
+
+
+class EmbeddingCache:
+    """Thread-safe LRU of text -> float32 embedding"""
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, text: str):
+        with self._lock:
+            vec = self._items.get(text)
+            if vec is None:
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(text)
+            self.stats["hits"] += 1
+            return vec
+
+    def set(self, text: str, vec):
+        # A list of Python floats is ~25 KB for 768 dims; float32 is an eighth of that
+        if not isinstance(vec, array):
+            vec = array("f", vec)
+        with self._lock:
+            self._items[text] = vec
+            self._items.move_to_end(text)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+class EmbeddingBatcher:
+    """Collects embed requests from many threads and encodes them in one batch"""
+
+    def __init__(self, embeddings, max_batch: int = 32, max_wait_seconds: float = 0.005):
+        self.embeddings = embeddings
+        self.max_batch = max_batch
+        self.max_wait_seconds = max_wait_seconds
+        self._queue = queue.Queue()
+        self.stats = {"batches": 0, "texts": 0}
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def embed(self, text: str) -> list:
+        """Blocking embed of one text, batched with whatever else arrives in the same window"""
+        done = threading.Event()
+        slot = {"text": text, "done": done, "vec": None, "error": None}
+        self._queue.put(slot)
+        done.wait()
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["vec"]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Keep collecting until the batch is full or the window closes
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get(timeout=self.max_wait_seconds))
+            except queue.Empty:
+                pass
+
+            try:
+                vectors = self.embeddings.embed_documents([slot["text"] for slot in batch])
+                for slot, vec in zip(batch, vectors):
+                    slot["vec"] = vec
+            except Exception as e:
+                for slot in batch:
+                    slot["error"] = e
+            self.stats["batches"] += 1
+            self.stats["texts"] += len(batch)
+            for slot in batch:
+                slot["done"].set()
@@ -2,16 +2,20 @@ import os, uuid, requests
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
 from .models import ConversationState
+from .llm_cache import CachedLLM
+from .resilience import breakers
 
 load_dotenv()
 
+SLACK_TIMEOUT_SECONDS = float(os.getenv("SLACK_TIMEOUT_SECONDS", "5"))
+
 # LLM for escalation summaries
-llm = ChatGoogleGenerativeAI(
+llm = CachedLLM(ChatGoogleGenerativeAI(
     model="gemini-2.0-flash-lite",
     google_api_key=os.getenv("GEMINI_API_KEY"),
     temperature=0.2,
     max_output_tokens=500,
-)
+))
 
 # =============================================================================
 # MOST FREQUENTLY USED FUNCTIONS (Main Flow)
@@ -69,7 +73,7 @@ def collect_escalation_info(state: ConversationState) -> bool:
     try:
         summary_prompt = f"Create a concise professional summary of this customer support issue for our human agents to understand: {state.original_question,state.question}. It contains both original and most recent question. Return only the summary content without any headings or formatting."
         response = llm.invoke(summary_prompt)
-        state.issue_summary = response.content.strip()
+        state.issue_summary = response.strip()
     except Exception as e:
         print(f"Error generating summary: {e}")
         state.issue_summary = f"Customer inquiry: {state.question}"
@@ -104,6 +108,10 @@ def create_support_ticket(state: ConversationState) -> str:
 
 def escalate_to_slack(contact_info, original_question, query, ticket_id, issue_summary):
     """Send escalation notification to Slack"""
+    breaker = breakers["slack"]
+    if not breaker.allow():
+        print("Slack circuit open, skipping webhook")
+        return False
     try:
         payload = {
             "text": f":rotating_light: *New Escalation Ticket* :rotating_light:\n"
@@ -116,13 +124,16 @@ def escalate_to_slack(contact_info, original_question, query, ticket_id, issue_s
                     f"*Issue Summary:* {issue_summary}"
         }
         
-        resp = requests.post(os.getenv("SLACK_WEBHOOK_URL"), json=payload)
+        resp = requests.post(os.getenv("SLACK_WEBHOOK_URL"), json=payload, timeout=SLACK_TIMEOUT_SECONDS)
         if resp.status_code == 200:
+            breaker.record_success()
             return True
         else:
+            breaker.record_failure()
             print(f"Slack webhook failed with status: {resp.status_code}")
             return False
     except Exception as e:
+        breaker.record_failure()
         print(f"Error escalating to Slack: {e}")
         return False
 
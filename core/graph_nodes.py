@@ -2,18 +2,30 @@
 LangGraph nodes and workflow management for BeWhoop Support Agent
 """
 from typing import TypedDict, Optional
+from array import array
 from langgraph.graph import StateGraph, START, END
-from .memory import semantic_memory_lookup, search_knowledge_base_internal, semantic_memory_upsert
+import os
+from .memory import (
+    search_knowledge_base_internal,
+    semantic_memory_upsert,
+    embed_query,
+    combine_query_vectors,
+    cosine_similarity
+)
 from .tools import (
     query_tools_parallel, 
     process_tool_results, 
     answer_with_llm, 
     is_escalation_request,
     ask_for_clarification,
-    make_agent_decision
+    make_agent_decision,
+    LLM_BUSY_MESSAGE
 )
+from .resilience import Deadline, DependencyUnavailableError, record_turn
 from .escalation import handle_escalation_flow
-from .models import ConversationState
+from .models import Answer, ConversationState
+from .chunk_store import chunk_store
+from .profiling import profile_turn, timed_stage
 
 # LangGraph State Schema
 class AgentState(TypedDict):
@@ -27,10 +39,22 @@ class AgentState(TypedDict):
     should_continue: str
     needs_storage: bool
     debug_info: str
+    deadline: Optional[Deadline]
+    # Per-session conversation state - lets many sessions share one compiled graph
+    conversation: ConversationState
+    interactive: bool
+    # Query embedding for this turn (for clarifications: original + clarification, combined)
+    query_vec: Optional[list]
+    intent_similarity: float
 
-# Global state variable (will be managed from main.py)
+# Global state variable (will be managed from main.py) - default session when none is passed in
 conversation_state = None
 MAX_CLARIFICATION_ATTEMPTS = 1
+# Returned instead of prompting for contact details when nobody is at the keyboard (batch runs)
+ESCALATION_REQUIRED_MESSAGE = "This question needs to be escalated to our human support team."
+# A clarification at least this similar to the original question keeps its routing decision
+INTENT_SIMILARITY_THRESHOLD = float(os.getenv("INTENT_SIMILARITY_THRESHOLD", "0.3"))
+RETRIEVAL_DECISIONS = ("need_memory", "need_kb_search", "need_both")
 
 def set_conversation_state(state: ConversationState):
     """Set the global conversation state"""
@@ -39,7 +63,7 @@ def set_conversation_state(state: ConversationState):
 
 def input_processor_node(state: AgentState) -> AgentState:
     """Process and prepare user input"""
-    global conversation_state
+    conversation_state = state["conversation"]
     
     user_input = state["user_input"]
     is_clarification = state.get("is_clarification", False)
@@ -49,7 +73,13 @@ def input_processor_node(state: AgentState) -> AgentState:
         # Combine original question with clarification
         question_to_process = f"{conversation_state.original_question} {user_input}"
         print(f"DEBUG: handle_clarification called, current attempts: {conversation_state.clarification_attempts}")
+        if conversation_state.query_embedding:
+            # Embed only the new text and move the first attempt's vector towards it
+            clarification_vec = embed_query(user_input.strip())
+            state["query_vec"] = combine_query_vectors(conversation_state.query_embedding, clarification_vec)
+            state["intent_similarity"] = cosine_similarity(conversation_state.query_embedding, clarification_vec)
     else:
+        conversation_state.reset_retrieval_context()
         # New question - update state and reset search results
         question_to_process = user_input.strip()
         conversation_state.question = question_to_process
@@ -64,7 +94,7 @@ def input_processor_node(state: AgentState) -> AgentState:
 
 def agent_decision_node(state: AgentState) -> AgentState:
     """Intelligent agent that decides which tools to use"""
-    global conversation_state
+    conversation_state = state["conversation"]
     
     question = state["processed_question"]
     user_input = state["user_input"]
@@ -76,8 +106,17 @@ def agent_decision_node(state: AgentState) -> AgentState:
         state["should_continue"] = "escalation_tool"
         return state
     
-    # Use LLM to make intelligent routing decision
-    decision = make_agent_decision(question, is_clarification, conversation_state.clarification_attempts)
+    if (is_clarification and conversation_state.last_decision in RETRIEVAL_DECISIONS and
+            state.get("intent_similarity", 0.0) >= INTENT_SIMILARITY_THRESHOLD):
+        # Same intent as the first attempt - skip the routing LLM call
+        decision = conversation_state.last_decision
+        print(f"DEBUG: Clarification keeps intent, reusing decision: {decision}")
+    else:
+        # Use LLM to make intelligent routing decision
+        decision = make_agent_decision(question, is_clarification, conversation_state.clarification_attempts,
+                                       deadline=state.get("deadline"))
+        if not is_clarification:
+            conversation_state.last_decision = decision
     
     print(f"DEBUG: Agent decision: {decision}")
     
@@ -107,15 +146,34 @@ def agent_decision_node(state: AgentState) -> AgentState:
     
     return state
 
+def _query_vector(state: AgentState) -> array:
+    """This turn's query embedding - computed once and shared by every search node"""
+    if state.get("query_vec") is None:
+        state["query_vec"] = embed_query(state["processed_question"])
+        if not state.get("is_clarification", False):
+            # Kept (float32) so a clarification only has to embed its own text; run_turn drops it
+            # again unless the turn ends by asking for one
+            state["conversation"].query_embedding = state["query_vec"]
+    return state["query_vec"]
+
+def _prior_candidates(state: AgentState) -> list:
+    """First attempt's KB candidates, reranked alongside a clarification's smaller search"""
+    return state["conversation"].kb_candidates if state.get("is_clarification", False) else None
+
 def memory_tool_node(state: AgentState) -> AgentState:
     """Search semantic memory"""
-    global conversation_state
+    conversation_state = state["conversation"]
     
     question = state["processed_question"]
     
-    memory_result = semantic_memory_lookup(question)
+    # KB comes back in the same round trip, so a memory miss doesn't cost a second RPC
+    memory_result, kb_result = query_tools_parallel(question, deadline=state.get("deadline"),
+                                                    query_vec=_query_vector(state),
+                                                    prior_candidates=_prior_candidates(state))
     
     state["memory_results"] = {"found": memory_result.found, "chunks": memory_result.chunks}
+    state["kb_results"] = {"found": kb_result.found, "chunks": kb_result.chunks,
+                           "candidates": kb_result.candidates}
     
     if memory_result.found:
         conversation_state.qa_found = True
@@ -130,13 +188,23 @@ def memory_tool_node(state: AgentState) -> AgentState:
 
 def kb_tool_node(state: AgentState) -> AgentState:
     """Search knowledge base"""
-    global conversation_state
+    conversation_state = state["conversation"]
     
     question = state["processed_question"]
     
-    kb_result = search_knowledge_base_internal(question)
+    prefetched = state.get("kb_results")
+    if prefetched is not None:
+        # Already fetched alongside memory by memory_tool
+        kb_result = Answer(found=prefetched["found"], chunks=prefetched["chunks"],
+                           candidates=prefetched.get("candidates"))
+    else:
+        kb_result = search_knowledge_base_internal(question, deadline=state.get("deadline"),
+                                                   query_vec=_query_vector(state),
+                                                   prior_candidates=_prior_candidates(state))
     
     state["kb_results"] = {"found": kb_result.found, "chunks": kb_result.chunks}
+    if not state.get("is_clarification", False):
+        conversation_state.kb_candidates = kb_result.candidates or []
     
     if kb_result.found:
         conversation_state.kb_found = True
@@ -152,13 +220,17 @@ def kb_tool_node(state: AgentState) -> AgentState:
 
 def parallel_search_node(state: AgentState) -> AgentState:
     """Search both memory and KB in parallel"""
-    global conversation_state
+    conversation_state = state["conversation"]
     
     question = state["processed_question"]
     is_clarification = state.get("is_clarification", False)
     
     # Query tools in parallel (Memory + KB)
-    memory_result, kb_result = query_tools_parallel(question)
+    memory_result, kb_result = query_tools_parallel(question, deadline=state.get("deadline"),
+                                                    query_vec=_query_vector(state),
+                                                    prior_candidates=_prior_candidates(state))
+    if not is_clarification:
+        conversation_state.kb_candidates = kb_result.candidates or []
     
     # Process results and update state
     conversation_state = process_tool_results(conversation_state, memory_result, kb_result)
@@ -180,11 +252,12 @@ def parallel_search_node(state: AgentState) -> AgentState:
 
 def answer_node(state: AgentState) -> AgentState:
     """Generate answer from available information"""
-    global conversation_state
+    conversation_state = state["conversation"]
     
     question = state["processed_question"]
     agent_decision = state.get("agent_decision", "")
     is_clarification = state.get("is_clarification", False)
+    deadline = state.get("deadline")
     
     # Handle direct answer case
     if agent_decision == "direct_answer":
@@ -199,15 +272,28 @@ Key features:
 
 For non-BeWhoop questions, politely decline and redirect to BeWhoop topics."""
         
-        answer = answer_with_llm(question, basic_context)
+        try:
+            answer = answer_with_llm(question, basic_context, deadline=deadline)
+        except DependencyUnavailableError:
+            answer = LLM_BUSY_MESSAGE
         state["response"] = answer
         state["should_continue"] = "end"
         return state
     
     # Priority: Memory → KB → No results
-    if conversation_state.qa_found and conversation_state.qa_chunks:
-        context = f"From Memory: {conversation_state.qa_chunks[0].get('answer', '')}"
-        answer = answer_with_llm(question, context)
+    # Chunk refs are resolved from the shared store; an evicted chunk counts as no result
+    qa_rows = chunk_store.resolve(conversation_state.qa_chunks)
+    kb_docs = chunk_store.resolve(conversation_state.kb_chunks)
+    
+    if conversation_state.qa_found and qa_rows:
+        memory_answer = qa_rows[0].get('answer', '')
+        context = f"From Memory: {memory_answer}"
+        try:
+            answer = answer_with_llm(question, context, deadline=deadline)
+        except DependencyUnavailableError:
+            # Under load or past budget, the stored answer is good enough as-is
+            print("DEBUG: Answer LLM unavailable, returning memory answer directly")
+            answer = memory_answer
         
         if answer == "CANNOT_ANSWER_WITH_CONTEXT":
             debug_msg = "after clarification" if is_clarification else "treating as no results"
@@ -219,9 +305,15 @@ For non-BeWhoop questions, politely decline and redirect to BeWhoop topics."""
         state["should_continue"] = "end"
         return state
     
-    elif conversation_state.kb_found and conversation_state.kb_chunks:
-        context = f"From Knowledge Base: {' '.join([doc.page_content for doc in conversation_state.kb_chunks])}"
-        answer = answer_with_llm(question, context)
+    elif conversation_state.kb_found and kb_docs:
+        context = f"From Knowledge Base: {' '.join([doc.page_content for doc in kb_docs])}"
+        try:
+            answer = answer_with_llm(question, context, deadline=deadline)
+        except DependencyUnavailableError:
+            print("DEBUG: Answer LLM unavailable, no fallback for KB context")
+            state["response"] = LLM_BUSY_MESSAGE
+            state["should_continue"] = "end"
+            return state
         
         if answer == "CANNOT_ANSWER_WITH_CONTEXT":
             debug_msg = "after clarification" if is_clarification else "treating as no results"
@@ -231,7 +323,7 @@ For non-BeWhoop questions, politely decline and redirect to BeWhoop topics."""
         
         # Store successful KB answer in memory
         if state.get("needs_storage", False):
-            semantic_memory_upsert(question, answer)
+            semantic_memory_upsert(question, answer, deadline=deadline)
         
         state["response"] = answer
         state["should_continue"] = "end"
@@ -244,7 +336,7 @@ For non-BeWhoop questions, politely decline and redirect to BeWhoop topics."""
 
 def clarification_tool_node(state: AgentState) -> AgentState:
     """Handle clarification or escalation"""
-    global conversation_state
+    conversation_state = state["conversation"]
     
     # Check if we've reached max clarification attempts
     if conversation_state.clarification_attempts >= MAX_CLARIFICATION_ATTEMPTS:
@@ -262,11 +354,19 @@ def clarification_tool_node(state: AgentState) -> AgentState:
 def escalation_tool_node(state: AgentState) -> AgentState:
     """Handle escalation to human support"""
     global conversation_state
+    session_state = state["conversation"]
     
     if state.get("agent_decision") == "escalate" and state.get("user_input"):
-        conversation_state.question = state["user_input"].strip()
+        session_state.question = state["user_input"].strip()
+    
+    if not state.get("interactive", True):
+        # Can't ask for contact details - just report that escalation is needed
+        state["debug_info"] = "escalation_required"
+        state["response"] = ESCALATION_REQUIRED_MESSAGE
+        state["should_continue"] = "end"
+        return state
     
-    escalated, message = handle_escalation_flow(conversation_state)
+    escalated, message = handle_escalation_flow(session_state)
     
     if escalated:
         state["response"] = message
@@ -275,7 +375,9 @@ def escalation_tool_node(state: AgentState) -> AgentState:
     else:
         # User declined escalation, reset for new question
         from .tools import reset_conversation
-        conversation_state = reset_conversation()
+        state["conversation"] = reset_conversation()
+        if session_state is conversation_state:
+            conversation_state = state["conversation"]
         state["response"] = message
         state["should_continue"] = "end"
         return state
@@ -288,15 +390,15 @@ def create_support_graph():
     """Create the intelligent LangGraph workflow"""
     workflow = StateGraph(AgentState)
     
-    # Add nodes
-    workflow.add_node("input_processor", input_processor_node)
-    workflow.add_node("agent_decision", agent_decision_node)
-    workflow.add_node("memory_tool", memory_tool_node)
-    workflow.add_node("kb_tool", kb_tool_node)
-    workflow.add_node("parallel_search", parallel_search_node)
-    workflow.add_node("answer_node", answer_node)
-    workflow.add_node("clarification_tool", clarification_tool_node)
-    workflow.add_node("escalation_tool", escalation_tool_node)
+    # Add nodes (timed_stage is a no-op unless the turn is being profiled)
+    workflow.add_node("input_processor", timed_stage("input_processor", input_processor_node))
+    workflow.add_node("agent_decision", timed_stage("agent_decision", agent_decision_node))
+    workflow.add_node("memory_tool", timed_stage("memory_tool", memory_tool_node))
+    workflow.add_node("kb_tool", timed_stage("kb_tool", kb_tool_node))
+    workflow.add_node("parallel_search", timed_stage("parallel_search", parallel_search_node))
+    workflow.add_node("answer_node", timed_stage("answer_node", answer_node))
+    workflow.add_node("clarification_tool", timed_stage("clarification_tool", clarification_tool_node))
+    workflow.add_node("escalation_tool", timed_stage("escalation_tool", escalation_tool_node))
     
     # Add edges
     workflow.add_edge(START, "input_processor")
@@ -371,8 +473,22 @@ def create_support_graph():
     
     return workflow.compile()
 
-def process_with_langgraph(user_input: str, is_clarification: bool = False):
-    """Process user input using intelligent LangGraph workflow"""
+# Compiled once and shared - the graph itself holds no per-session state
+support_graph = None
+
+def get_support_graph():
+    """Return the shared compiled graph, compiling it on first use"""
+    global support_graph
+    if support_graph is None:
+        support_graph = create_support_graph()
+    return support_graph
+
+def run_turn(user_input: str, is_clarification: bool = False, conversation: ConversationState = None,
+             interactive: bool = True, trace_id: str = None) -> AgentState:
+    """Run one turn through the graph and return the final graph state
+    (profiled if sampled, or if trace_id is one of the requested trace ids)"""
+    session = conversation if conversation is not None else conversation_state
+    attempts_before = session.clarification_attempts
     initial_state = {
         "user_input": user_input,
         "is_clarification": is_clarification,
@@ -383,10 +499,28 @@ def process_with_langgraph(user_input: str, is_clarification: bool = False):
         "response": "",
         "should_continue": "",
         "needs_storage": False,
-        "debug_info": ""
+        "debug_info": "",
+        # Every tool in this turn shares one latency budget
+        "deadline": Deadline(),
+        "conversation": session,
+        "interactive": interactive,
+        "query_vec": None,
+        "intent_similarity": 0.0
     }
     
-    # Create and run the graph
-    support_graph = create_support_graph()
-    result = support_graph.invoke(initial_state)
-    return result["response"] 
\ No newline at end of file
+    with profile_turn(trace_id) as profile:
+        result = get_support_graph().invoke(initial_state)
+        if profile is not None:
+            profile.decision = result.get("agent_decision", "")
+    if session.clarification_attempts <= attempts_before:
+        # Answered or escalated - the next message is a new question, so nothing will reuse the
+        # first attempt's retrieval and it may ask for clarification again
+        session.clarification_attempts = 0
+        session.reset_retrieval_context()
+    record_turn(initial_state["deadline"])
+    return result
+
+def process_with_langgraph(user_input: str, is_clarification: bool = False, conversation: ConversationState = None,
+                           interactive: bool = True, trace_id: str = None):
+    """Process user input using intelligent LangGraph workflow"""
+    return run_turn(user_input, is_clarification, conversation, interactive, trace_id)["response"] 
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""
+Persistent memoization layer for deterministic LLM calls
+"""
+import os, time, hashlib, sqlite3, threading
+from typing import Optional
+from dotenv import load_dotenv
+from .llm_limiter import gemini_limiter, gemini_single_flight
+from .resilience import Deadline, ensure_deadline, call_with_timeout, breakers, CircuitOpenError
+
+load_dotenv()
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".cache/llm_cache.sqlite3")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+# Pruning expired/overflowing rows on every write would be wasteful
+PRUNE_EVERY_WRITES = 200
+
+
+class LLMCache:
+    """Bounded on-disk cache with TTL - sqlite file so every worker process shares it"""
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_seconds: int = LLM_CACHE_TTL_SECONDS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()  # sqlite connections can't be shared across threads
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "writes": 0, "errors": 0}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # WAL lets readers in other workers proceed while one worker writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_created_idx ON llm_cache (created_at)")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    @staticmethod
+    def make_key(model: str, temperature, prompt: str, extra: str = "") -> str:
+        """Hash of (model, temperature, rendered prompt)"""
+        raw = f"{model}\x1f{temperature}\x1f{extra}\x1f{prompt}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            row = self._conn().execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading LLM cache: {e}")
+            self._count("errors")
+            return None
+
+        if row is None or row[1] < time.time():
+            self._count("misses")
+            return None
+        self._count("hits")
+        return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now + self.ttl_seconds)
+            )
+        except sqlite3.Error as e:
+            print(f"Error writing LLM cache: {e}")
+            self._count("errors")
+            return
+
+        with self._lock:
+            self.stats["writes"] += 1
+            self._writes += 1
+            should_prune = self._writes % PRUNE_EVERY_WRITES == 0
+        if should_prune:
+            self.prune()
+
+    def prune(self):
+        """Drop expired rows, then the oldest rows beyond max_entries"""
+        try:
+            conn = self._conn()
+            conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY created_at ASC "
+                "LIMIT MAX((SELECT COUNT(*) FROM llm_cache) - ?, 0))",
+                (self.max_entries,)
+            )
+        except sqlite3.Error as e:
+            print(f"Error pruning LLM cache: {e}")
+            self._count("errors")
+
+    def size(self) -> int:
+        try:
+            return self._conn().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        except sqlite3.Error:
+            return -1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["entries"] = self.size()
+        return stats
+
+
+# Shared by every CachedLLM in this process (and every process via the sqlite file)
+llm_cache = LLMCache()
+
+
+def _render(prompt) -> str:
+    """Render a prompt (string, PromptValue or message list) to the exact text sent to the model"""
+    if hasattr(prompt, "to_string"):
+        return prompt.to_string()
+    if isinstance(prompt, list):
+        return "\n".join(f"{getattr(m, 'type', '')}: {getattr(m, 'content', m)}" for m in prompt)
+    return str(prompt)
+
+
+class CachedLLM:
+    """Chat model wrapper that returns the cached completion for a repeated (model, temperature, prompt).
+    Misses are coalesced per key and go through the shared adaptive concurrency limiter."""
+
+    def __init__(self, llm, cache: LLMCache = llm_cache, limiter=gemini_limiter,
+                 single_flight=gemini_single_flight):
+        self.llm = llm
+        self.cache = cache
+        self.limiter = limiter
+        self.single_flight = single_flight
+        self.model = getattr(llm, "model", "")
+        self.temperature = getattr(llm, "temperature", None)
+
+    def _call_upstream(self, prompt, deadline: Deadline) -> str:
+        # Raises LLMOverloadedError when shed, CircuitOpenError/DeadlineExceededError when skipped
+        breaker = breakers["llm"]
+        self.limiter.acquire(timeout=min(self.limiter.max_wait, deadline.timeout()))
+        try:
+            # Checked after queueing so a half-open trial is never lost to a shed call
+            breaker.check()
+        except CircuitOpenError:
+            self.limiter.release_when_done(None)
+            raise
+        try:
+            # The slot is held until Gemini actually returns, not just until this turn stops waiting
+            response = call_with_timeout("llm", self.llm.invoke, deadline, prompt,
+                                         on_done=self.limiter.release_when_done)
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return response.content
+
+    def invoke(self, prompt, use_cache: bool = True, deadline: Deadline = None) -> str:
+        """Return the model's text content for prompt; use_cache=False skips read and write"""
+        deadline = ensure_deadline(deadline)
+        if not (use_cache and LLM_CACHE_ENABLED):
+            self.cache._count("bypassed")
+            return self._call_upstream(prompt, deadline)
+
+        # max_output_tokens can truncate an answer, so it's part of the key too
+        key = self.cache.make_key(
+            self.model, self.temperature, _render(prompt),
+            extra=str(getattr(self.llm, "max_output_tokens", ""))
+        )
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        def fetch() -> str:
+            content = self._call_upstream(prompt, deadline)
+            self.cache.set(key, content)
+            return content
+
+        # Identical concurrent misses (e.g. an incident spike) share one upstream call
+        return self.single_flight.do(key, fetch, timeout=deadline.timeout())
+
+
+def get_llm_cache_stats() -> dict:
+    """Cache hit/miss counters for this process plus the shared entry count"""
+    return llm_cache.get_stats()
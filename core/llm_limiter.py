@@ -0,0 +1,177 @@
+"""
+Request coalescing and adaptive concurrency limiting for outbound LLM calls
+"""
+import os, time, threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from .resilience import DependencyUnavailableError, DeadlineExceededError
+
+load_dotenv()
+
+LLM_INITIAL_CONCURRENCY = float(os.getenv("LLM_INITIAL_CONCURRENCY", "8"))
+LLM_MIN_CONCURRENCY = float(os.getenv("LLM_MIN_CONCURRENCY", "1"))
+LLM_MAX_CONCURRENCY = float(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "200"))
+LLM_MAX_QUEUE_WAIT_SECONDS = float(os.getenv("LLM_MAX_QUEUE_WAIT_SECONDS", "10"))
+
+
+class LLMOverloadedError(DependencyUnavailableError):
+    """Raised when a call is shed instead of queued - callers should degrade, not retry"""
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Best-effort check for Gemini 429 / quota errors across client versions"""
+    text = f"{type(error).__name__} {error}".lower()
+    return ("429" in text or "resourceexhausted" in text or
+            "rate limit" in text or "quota" in text)
+
+
+class SingleFlight:
+    """Identical in-flight calls share one upstream call"""
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def do(self, key: str, fn, timeout: float = None):
+        """Run fn once per key at a time; concurrent callers with the same key get its result"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._Call()
+                self._calls[key] = call
+                self.stats["leaders"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise DeadlineExceededError("Timed out waiting for a coalesced LLM call")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit with a bounded wait queue - sheds load instead of piling up"""
+
+    def __init__(self, initial: float = LLM_INITIAL_CONCURRENCY, minimum: float = LLM_MIN_CONCURRENCY,
+                 maximum: float = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE,
+                 max_wait: float = LLM_MAX_QUEUE_WAIT_SECONDS):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.queued = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            "acquired": 0, "shed_queue_full": 0, "shed_timeout": 0,
+            "rate_limited": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0
+        }
+
+    def _acquire(self, timeout: float):
+        start = time.monotonic()
+        with self._cond:
+            if self.in_flight >= int(self.limit) and self.queued >= self.max_queue:
+                self.stats["shed_queue_full"] += 1
+                raise LLMOverloadedError("LLM queue is full")
+
+            self.queued += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self.stats["shed_timeout"] += 1
+                        raise LLMOverloadedError("Timed out waiting for an LLM slot")
+                    self._cond.wait(remaining)
+            finally:
+                self.queued -= 1
+
+            self.in_flight += 1
+            waited = time.monotonic() - start
+            self.stats["acquired"] += 1
+            self.stats["total_wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    def _release(self, error: Exception = None, completed: bool = True):
+        with self._cond:
+            self.in_flight -= 1
+            if not completed:
+                # Cancelled or skipped before reaching upstream - says nothing about capacity
+                pass
+            elif error is not None and is_rate_limit_error(error):
+                # Multiplicative decrease on upstream pushback
+                self.stats["rate_limited"] += 1
+                self.limit = max(self.minimum, self.limit / 2)
+            elif error is None:
+                # Additive increase: roughly +1 per "window" of successful calls
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, timeout: float = None):
+        """Hold one concurrency slot for the duration of an upstream call"""
+        self._acquire(self.max_wait if timeout is None else timeout)
+        try:
+            yield
+        except Exception as e:
+            self._release(e)
+            raise
+        else:
+            self._release()
+
+    def acquire(self, timeout: float = None):
+        """Take a slot to be given back by release_when_done (for calls that outlive their caller)"""
+        self._acquire(self.max_wait if timeout is None else timeout)
+
+    def release_when_done(self, future):
+        """Done-callback for a call made under acquire(): frees the slot only once the upstream
+        call has really finished, so timed-out calls still count against the limit"""
+        if future is None or future.cancelled():
+            self._release(completed=False)
+        else:
+            self._release(future.exception())
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            stats = dict(self.stats)
+            stats["limit"] = round(self.limit, 2)
+            stats["in_flight"] = self.in_flight
+            stats["queued"] = self.queued
+        acquired = stats["acquired"]
+        stats["avg_wait_seconds"] = round(stats["total_wait_seconds"] / acquired, 4) if acquired else 0.0
+        stats["shed"] = stats["shed_queue_full"] + stats["shed_timeout"]
+        return stats
+
+
+# One limiter per process - every Gemini client shares the same API quota
+gemini_limiter = AdaptiveLimiter()
+gemini_single_flight = SingleFlight()
+
+
+def get_llm_limiter_stats() -> dict:
+    """Queue wait, shed counts, current limit and coalescing counters"""
+    stats = gemini_limiter.get_stats()
+    stats.update(gemini_single_flight.stats)
+    return stats
@@ -1,12 +1,35 @@
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import SupabaseVectorStore
+from langchain_core.documents import Document
 from db.db import supabase_client
-from .models import Answer
-import os
+from .models import Answer, ChunkRef
+from .chunk_store import chunk_store
+from .sections import classify_section
+from .embedding_batcher import EmbeddingBatcher, EmbeddingCache
+from .retrieval_cache import retrieval_cache, bump_retrieval_version
+from .resilience import Deadline, ensure_deadline, hedged_call, call_with_timeout, breakers
+from .profiling import stage
+import os, math
+from array import array
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# How much a clarification's embedding moves the original query vector
+CLARIFICATION_WEIGHT = float(os.getenv("CLARIFICATION_WEIGHT", "0.7"))
+# Discount on the first attempt's candidates when reranking them on a clarification
+PRIOR_CANDIDATE_DECAY = float(os.getenv("PRIOR_CANDIDATE_DECAY", "0.9"))
+# Send query vectors as short pgvector text instead of a JSON list of full-precision floats
+COMPACT_VECTOR_ENCODING = os.getenv("COMPACT_VECTOR_ENCODING", "true").lower() not in ("0", "false", "no")
+# Match small child chunks but return their whole parent sections (see loader.py); off for a
+# KB still stored with fixed-size chunks
+KB_PARENT_SECTIONS = os.getenv("KB_PARENT_SECTIONS", "true").lower() not in ("0", "false", "no")
+KB_MATCH_RPC = "match_document_sections" if KB_PARENT_SECTIONS else "match_documents"
+KB_MATCH_COUNT = 3
+# Upper bound on KB text handed to the LLM per turn
+KB_CONTEXT_MAX_CHARS = int(os.getenv("KB_CONTEXT_MAX_CHARS", "4000"))
+MIN_KB_CONTEXT_CHARS = 400
+KB_CACHE_SIGNATURE = f"{KB_MATCH_RPC}:k={KB_MATCH_COUNT}"
+
 # Embeddings
 embeddings = HuggingFaceEmbeddings(
     model_name="sentence-transformers/all-mpnet-base-v2",
@@ -14,60 +37,308 @@ embeddings = HuggingFaceEmbeddings(
     encode_kwargs={"normalize_embeddings": True}
 )
 
-# Vector store
-vector_store = SupabaseVectorStore(
-    embedding=embeddings,
-    client=supabase_client,
-    table_name="documents",
-    query_name="match_documents",
-)
+# Repeated questions (and memory + KB for the same turn) embed the same text only once
+embedding_cache = EmbeddingCache()
+# Off by default - batching only pays off when many turns run concurrently (see batch.py)
+embedding_batcher = None
 
-def semantic_memory_lookup(query: str, threshold: float = 0.82) -> Answer:
-    """Search for previously answered questions in semantic memory"""
-    # Turning query to vector for semantic search
-    query_vec = embeddings.embed_query(query)
-    # Searching
-    response = supabase_client.rpc(
-        "match_qa_memory",
-        {"query_embedding": query_vec, "match_threshold": threshold, "match_count": 1}
-    ).execute()
-    data = getattr(response, "data", None) or []
-    
-    if data and len(data) > 0:
-        result = data[0]
+def enable_embedding_batching(max_batch: int = 32, max_wait_seconds: float = 0.005) -> EmbeddingBatcher:
+    """Route every embed_query call through one shared batcher"""
+    global embedding_batcher
+    if embedding_batcher is None:
+        embedding_batcher = EmbeddingBatcher(embeddings, max_batch, max_wait_seconds)
+    return embedding_batcher
+
+def embed_query(text: str) -> array:
+    """Embed a query as a float32 array, using the shared cache and batcher when available"""
+    vec = embedding_cache.get(text)
+    if vec is None:
+        with stage("embedding"):
+            vec = embedding_batcher.embed(text) if embedding_batcher else embeddings.embed_query(text)
+        vec = array("f", vec)
+        embedding_cache.set(text, vec)
+    return vec
+
+def _cached_retrieval(kind: str, signature: str, query_vec: list):
+    """Cached Answer for this query vector, if its chunks are still in the chunk store"""
+    cached = retrieval_cache.get(kind, signature, query_vec)
+    if cached is not None and len(chunk_store.resolve(cached.chunks or [])) == len(cached.chunks or []):
+        return cached
+    return None
+
+def encode_vector(vec: list):
+    """Query vector as an RPC parameter - '[0.0123457,...]' text is under half the size of
+    Python's float repr and pgvector parses it directly"""
+    if not COMPACT_VECTOR_ENCODING:
+        return list(vec)
+    return "[" + ",".join(f"{x:.6g}" for x in vec) + "]"
+
+def _rpc(name: str, params: dict):
+    """Execute a Supabase RPC and return its rows"""
+    response = supabase_client.rpc(name, params).execute()
+    return getattr(response, "data", None) or []
+
+def _memory_answer(rows: list) -> Answer:
+    """Turn match_qa_memory rows into an Answer, applying the answer quality check"""
+    if rows and len(rows) > 0:
+        result = rows[0]
         # Validate the answer quality
         answer = result.get('answer', '').strip()
         if (answer and 
             len(answer) > 20 ):
-            return Answer(found=True, chunks=[result])
-    
+            # Row is kept once in the chunk store; state only carries the reference
+            ref_id = f"qa:{result.get('id')}"
+            chunk_store.put(ref_id, result)
+            return Answer(found=True, chunks=[ChunkRef(ref_id, result.get("similarity") or 0.0)])
     return Answer(found=False, chunks=[])
 
-def search_knowledge_base_internal(query: str) -> Answer:
-    """Search the knowledge base and return raw chunks - no LLM processing"""
+def semantic_memory_lookup(query: str, threshold: float = 0.82, deadline: Deadline = None,
+                           query_vec: list = None, check_cache: bool = True) -> Answer:
+    """Search for previously answered questions in semantic memory (query_vec skips embedding query)"""
+    deadline = ensure_deadline(deadline)
+    breaker = breakers["memory"]
+    if deadline.spent():
+        print("DEBUG: Turn budget exhausted, skipping memory lookup")
+        return Answer(found=False, chunks=[])
+    # Memory is an optimisation - when it's down, skip it and let the caller fall back to KB
+    if not breaker.allow():
+        print("DEBUG: Memory circuit open, skipping memory lookup")
+        return Answer(found=False, chunks=[])
+    
+    # Turning query to vector for semantic search
+    if query_vec is None:
+        query_vec = embed_query(query)
+    # Near-identical queries reuse the last result (hits and misses alike) until memory changes
+    signature = f"threshold={threshold}"
+    cached = _cached_retrieval("memory", signature, query_vec) if check_cache else None
+    if cached is not None:
+        breaker.record_success()
+        return cached
+    
+    # Searching (duplicated if it runs past the RPC's recent p95)
+    version = retrieval_cache.version("memory")
+    try:
+        data = hedged_call(
+            "match_qa_memory", _rpc, deadline, "match_qa_memory",
+            {"query_embedding": encode_vector(query_vec), "match_threshold": threshold, "match_count": 1}
+        )
+        breaker.record_success()
+    except Exception as e:
+        breaker.record_failure()
+        print(f"Error in semantic memory lookup: {e}")
+        return Answer(found=False, chunks=[])
+    
+    memory_answer = _memory_answer(data)
+    retrieval_cache.set("memory", signature, query_vec, memory_answer, version)
+    return memory_answer
+
+def combine_query_vectors(original: list, addition: list, weight: float = CLARIFICATION_WEIGHT) -> array:
+    """Normalized original + weight * addition - the clarified query without re-embedding the whole text"""
+    combined = [o + weight * a for o, a in zip(original, addition)]
+    norm = math.sqrt(sum(x * x for x in combined)) or 1.0
+    return array("f", (x / norm for x in combined))
+
+def cosine_similarity(a: list, b: list) -> float:
+    """Dot product - embeddings are normalized"""
+    return sum(x * y for x, y in zip(a, b))
+
+def _kb_answer(rows: list, prior_candidates: list = None) -> Answer:
+    """Turn match_document_sections (or match_documents) rows into an Answer, applying the size cap
+    and meaningful-content check.
+    prior_candidates (an earlier attempt's candidates) are reranked in alongside the new rows."""
+    ranked = {}
+    for row in rows:
+        doc = Document(id=str(row.get("id")), page_content=row.get("content", ""), metadata=row.get("metadata") or {})
+        ref_id = f"kb:{doc.id}"
+        chunk_store.put(ref_id, doc)
+        ranked[ref_id] = ChunkRef(ref_id, row.get("similarity") or 0.0)
+    for ref in prior_candidates or []:
+        # Scored against the old query, so they only win when clearly better than the new hits
+        if ref.id not in ranked and chunk_store.get(ref.id) is not None:
+            ranked[ref.id] = ChunkRef(ref.id, ref.score * PRIOR_CANDIDATE_DECAY)
+    candidates = sorted(ranked.values(), key=lambda ref: ref.score, reverse=True)
+    
+    # Best matches first, stopping before the context grows past the size cap
+    top, relevant_docs, size = [], [], 0
+    for ref in candidates:
+        doc = chunk_store.get(ref.id)
+        if doc is None:
+            continue
+        if len(top) == KB_MATCH_COUNT or (top and size + len(doc.page_content) > KB_CONTEXT_MAX_CHARS):
+            break
+        top.append(ref)
+        relevant_docs.append(doc)
+        size += len(doc.page_content)
+    if not relevant_docs:
+        return Answer(found=False, chunks=[], candidates=candidates)
+    
+    # Check if documents contain meaningful content - a whole KB section counts however short,
+    # fixed-size fragments need enough text
+    doc_content = " ".join([doc.page_content for doc in relevant_docs])
+    complete = any(doc.metadata.get("chunk_type") == "section" for doc in relevant_docs)
+    if not complete and len(doc_content.strip()) < MIN_KB_CONTEXT_CHARS:
+        return Answer(found=False, chunks=[], candidates=candidates)
+    
+    # Return references to the raw chunks - the main LLM resolves and processes them
+    return Answer(found=True, chunks=top, candidates=candidates)
+
+def search_knowledge_base_internal(query: str, deadline: Deadline = None, query_vec: list = None,
+                                   prior_candidates: list = None, check_cache: bool = True) -> Answer:
+    """Search the knowledge base and return raw chunks - no LLM processing.
+    query_vec skips embedding query; prior_candidates are reranked with the new results."""
+    deadline = ensure_deadline(deadline)
+    breaker = breakers["kb"]
+    if deadline.spent():
+        print("DEBUG: Turn budget exhausted, skipping knowledge base search")
+        return Answer(found=False, chunks=[])
+    if not breaker.allow():
+        print("DEBUG: KB circuit open, skipping knowledge base search")
+        return Answer(found=False, chunks=[])
+    
+    if query_vec is None:
+        query_vec = embed_query(query)
+    # A clarification's result depends on its prior candidates, so only plain searches are cached
+    signature = KB_CACHE_SIGNATURE
+    if not prior_candidates and check_cache:
+        cached = _cached_retrieval("kb", signature, query_vec)
+        if cached is not None:
+            breaker.record_success()
+            return cached
+    
+    # Narrow the search to one section when the query clearly belongs to it
+    section = classify_section(query_vec)
+    params = {"query_embedding": encode_vector(query_vec), "match_count": KB_MATCH_COUNT}
+    version = retrieval_cache.version("kb")
+    
+    # Fetching sections (or chunks) - called directly rather than via the vector store so it can be hedged
     try:
-        # Fetching chunks
-        relevant_docs = vector_store.similarity_search(query, k=3)
-        if not relevant_docs:
-            return Answer(found=False, chunks=[])
-        
-        # Check if documents contain meaningful content
-        doc_content = " ".join([doc.page_content for doc in relevant_docs])
-        if len(doc_content.strip()) < 400:
-            return Answer(found=False, chunks=[])
-        
-        # Return raw chunks - let the main LLM process them
-        return Answer(found=True, chunks=relevant_docs)
-        
+        if section:
+            print(f"DEBUG: KB search narrowed to section: {section}")
+            result = _kb_answer(hedged_call(
+                KB_MATCH_RPC, _rpc, deadline, KB_MATCH_RPC,
+                dict(params, filter={"section": section})
+            ), prior_candidates)
+            if result.found:
+                breaker.record_success()
+                if not prior_candidates:
+                    retrieval_cache.set("kb", signature, query_vec, result, version)
+                return result
+            # Misclassified or thin section - fall back to the whole KB
+        rows = hedged_call(KB_MATCH_RPC, _rpc, deadline, KB_MATCH_RPC, params)
+        breaker.record_success()
     except Exception as e:
+        breaker.record_failure()
         print(f"Error in knowledge base search: {e}")
         return Answer(found=False, chunks=[])
+    
+    result = _kb_answer(rows, prior_candidates)
+    if not prior_candidates:
+        retrieval_cache.set("kb", signature, query_vec, result, version)
+    return result
+
+def search_memory_and_kb(query: str, threshold: float = 0.82, deadline: Deadline = None,
+                         query_vec: list = None, prior_candidates: list = None) -> tuple[Answer, Answer]:
+    """Memory lookup and KB search in one Supabase round trip (match_memory_and_documents)"""
+    deadline = ensure_deadline(deadline)
+    if query_vec is None:
+        query_vec = embed_query(query)
+    
+    memory_signature = f"threshold={threshold}"
+    memory_cached = _cached_retrieval("memory", memory_signature, query_vec)
+    kb_cached = None if prior_candidates else _cached_retrieval("kb", KB_CACHE_SIGNATURE, query_vec)
+    healthy = breakers["memory"].state == "closed" and breakers["kb"].state == "closed"
+    if memory_cached is not None or kb_cached is not None or not healthy or deadline.expired():
+        # Only fetch what's missing, and let the single-source calls handle open breakers / budget
+        memory_result = memory_cached or semantic_memory_lookup(
+            query, threshold, deadline, query_vec, check_cache=False)
+        kb_result = kb_cached or search_knowledge_base_internal(
+            query, deadline, query_vec, prior_candidates, check_cache=False)
+        return memory_result, kb_result
+    
+    section = classify_section(query_vec)
+    params = {
+        "query_embedding": encode_vector(query_vec),
+        "match_threshold": threshold,
+        "memory_count": 1,
+        "kb_count": KB_MATCH_COUNT,
+        "filter": {"section": section} if section else None,
+        "parent_sections": KB_PARENT_SECTIONS,
+    }
+    memory_version, kb_version = retrieval_cache.version("memory"), retrieval_cache.version("kb")
+    try:
+        data = hedged_call("match_memory_and_documents", _rpc, deadline, "match_memory_and_documents", params)
+        # A jsonb result comes back as the object itself, or wrapped in a list by some clients
+        if isinstance(data, list):
+            data = data[0] if data else {}
+        breakers["memory"].record_success()
+        breakers["kb"].record_success()
+    except Exception as e:
+        breakers["memory"].record_failure()
+        breakers["kb"].record_failure()
+        print(f"Error in combined memory/KB search: {e}")
+        return Answer(found=False, chunks=[]), Answer(found=False, chunks=[])
+    
+    memory_result = _memory_answer(data.get("memory") or [])
+    retrieval_cache.set("memory", memory_signature, query_vec, memory_result, memory_version)
+    
+    kb_result = _kb_answer(data.get("documents") or [], prior_candidates)
+    if section and not kb_result.found:
+        # Misclassified or thin section - fall back to the whole KB
+        print(f"DEBUG: Section {section} too thin, searching whole KB")
+        try:
+            rows = hedged_call(KB_MATCH_RPC, _rpc, deadline, KB_MATCH_RPC,
+                               {"query_embedding": params["query_embedding"], "match_count": KB_MATCH_COUNT})
+            kb_result = _kb_answer(rows, prior_candidates)
+        except Exception as e:
+            breakers["kb"].record_failure()
+            print(f"Error in knowledge base search: {e}")
+            return memory_result, kb_result
+    if not prior_candidates:
+        retrieval_cache.set("kb", KB_CACHE_SIGNATURE, query_vec, kb_result, kb_version)
+    
+    return memory_result, kb_result
 
-def semantic_memory_upsert(question: str, answer: str):
+def semantic_memory_upsert(question: str, answer: str, deadline: Deadline = None):
     """Store question-answer pair in semantic memory"""
+    deadline = ensure_deadline(deadline)
+    breaker = breakers["memory"]
+    # Storage is best-effort - never hold the user's answer hostage to it
+    if deadline.spent() or not breaker.allow():
+        print("DEBUG: Skipping semantic memory upsert")
+        return
+    
     # Converting Query to vectors
-    q_vec = embeddings.embed_query(question)
+    q_vec = embed_query(question)
     # Making payload as json, because upsert accepts json
-    payload = {"question": question, "answer": answer, "q_embedding": q_vec}
+    payload = {"question": question, "answer": answer, "q_embedding": list(q_vec)}
     # Uploading Q/A to qa_memory table with question as a unique value
-    supabase_client.table("qa_memory").upsert(payload, on_conflict="question").execute() 
\ No newline at end of file
+    try:
+        call_with_timeout(
+            "qa_memory_upsert",
+            lambda: supabase_client.table("qa_memory").upsert(payload, on_conflict="question").execute(),
+            deadline
+        )
+        breaker.record_success()
+        # Cached memory misses (and hits) may no longer be right
+        bump_retrieval_version("memory")
+    except Exception as e:
+        breaker.record_failure()
+        print(f"Error storing semantic memory: {e}") 
+
+def semantic_memory_upsert_many(rows: list[dict], batch_size: int = 500) -> int:
+    """Bulk store Q/A rows; embeds all questions in batches and upserts in chunks. Returns rows written"""
+    # Postgres rejects an upsert that touches the same row twice - last one wins
+    rows = list({row["question"]: row for row in rows}.values())
+    if not rows:
+        return 0
+    # One forward pass per batch instead of one per question
+    questions = [row["question"] for row in rows]
+    vectors = []
+    for i in range(0, len(questions), batch_size):
+        vectors.extend(embeddings.embed_documents(questions[i:i + batch_size]))
+    
+    payload = [dict(row, q_embedding=vec) for row, vec in zip(rows, vectors)]
+    for i in range(0, len(payload), batch_size):
+        supabase_client.table("qa_memory").upsert(payload[i:i + batch_size], on_conflict="question").execute()
+    bump_retrieval_version("memory")
+    return len(payload)
@@ -1,20 +1,35 @@
 from typing import List, Optional
-from dataclasses import dataclass
+from array import array
+from dataclasses import dataclass, fields
+import json
 
-@dataclass
+# Bump when ConversationState fields change so old checkpoints are rejected, not misread
+CHECKPOINT_VERSION = 2
+# Large and recomputable - left out of checkpoints (a restored session just re-embeds)
+TRANSIENT_FIELDS = ("query_embedding",)
+
+@dataclass(slots=True, frozen=True)
+class ChunkRef:
+    """Reference to a retrieved chunk - text lives once in the shared chunk store"""
+    id: str
+    score: float = 0.0
+
+@dataclass(slots=True)
 class Answer:
     """Standard response format for Memory and KB tools"""
     found: bool  # true | false
-    chunks: Optional[List] = None
+    chunks: Optional[List[ChunkRef]] = None
+    # Everything retrieved (found or not) - kept so a clarification can rerank instead of re-search
+    candidates: Optional[List[ChunkRef]] = None
 
-@dataclass
+@dataclass(slots=True)
 class ConversationState:
     """State schema for tracking conversation flow"""
     original_question: str = "asdqadqasdq"
     question: str = ""
     answer: str = ""
-    qa_chunks: List = None
-    kb_chunks: List = None
+    qa_chunks: List[ChunkRef] = None
+    kb_chunks: List[ChunkRef] = None
     qa_found: bool = False
     kb_found: bool = False
     escalation_needed: bool = False
@@ -22,12 +37,19 @@ class ConversationState:
     number: str = ""
     issue_summary: str = ""
     clarification_attempts: int = 0
+    # First attempt's retrieval, reused by clarification turns - only kept while one is awaited.
+    # The embedding is a float32 array (~3 KB for 768 dims, vs ~25 KB as a list of floats)
+    query_embedding: Optional[array] = None
+    kb_candidates: List[ChunkRef] = None
+    last_decision: str = ""
     
     def __post_init__(self):
         if self.qa_chunks is None:
             self.qa_chunks = []
         if self.kb_chunks is None:
             self.kb_chunks = []
+        if self.kb_candidates is None:
+            self.kb_candidates = []
     
     def reset_search_results(self):
         """Reset search-related fields for new queries"""
@@ -37,6 +59,38 @@ class ConversationState:
         self.kb_found = False
         self.answer = ""
     
+    def reset_retrieval_context(self):
+        """Forget the first attempt's embedding, candidates and routing (new question, or turn over)"""
+        self.query_embedding = None
+        self.kb_candidates = []
+        self.last_decision = ""
+    
     def has_results(self) -> bool:
         """Check if either memory or KB found results"""
-        return self.qa_found or self.kb_found 
\ No newline at end of file
+        return self.qa_found or self.kb_found
+    
+    def to_checkpoint(self) -> str:
+        """Compact positional JSON for session checkpoints - chunk refs become [id, score] pairs"""
+        values = []
+        for field in fields(self):
+            if field.name in TRANSIENT_FIELDS:
+                continue
+            value = getattr(self, field.name)
+            if field.name in ("qa_chunks", "kb_chunks", "kb_candidates"):
+                value = [[ref.id, round(ref.score, 4)] for ref in value]
+            values.append(value)
+        return json.dumps([CHECKPOINT_VERSION, values], separators=(",", ":"), ensure_ascii=False)
+    
+    @classmethod
+    def from_checkpoint(cls, data: str) -> "ConversationState":
+        """Inverse of to_checkpoint"""
+        version, values = json.loads(data)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version: {version}")
+        kwargs = {}
+        persisted = [field for field in fields(cls) if field.name not in TRANSIENT_FIELDS]
+        for field, value in zip(persisted, values):
+            if field.name in ("qa_chunks", "kb_chunks", "kb_candidates"):
+                value = [ChunkRef(ref_id, score) for ref_id, score in value]
+            kwargs[field.name] = value
+        return cls(**kwargs)
@@ -0,0 +1,379 @@
+"""
+Opt-in per-turn profiling: a statistical stack sampler plus allocation stats for a sampled
+fraction of turns, or for turns whose trace id is listed.
+
+Each profiled turn writes two files to PROFILE_DIR, named <time>-<decision>-<trace id>:
+  .collapsed  folded stacks ("frame;frame;frame count") for flamegraph.pl, speedscope, etc.
+  .json       routing decision, per-stage timings, sample count and allocation stats
+
+Settings come from the environment, can be changed in-process with configure(), and are
+re-read from PROFILE_CONTROL_FILE whenever that file changes - so sampling can be switched on
+for a running server (every worker) without a restart.
+"""
+import os, re, sys, gc, json, math, time, random, threading, tracemalloc, uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", ".cache/profiles")
+PROFILE_CONTROL_FILE = os.getenv("PROFILE_CONTROL_FILE", ".cache/profiling.json")
+CONTROL_CHECK_SECONDS = 1.0
+MAX_STACK_DEPTH = 128
+TOP_ALLOCATIONS = 15
+
+_settings = {
+    "sample_rate": float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    "trace_ids": [t for t in os.getenv("PROFILE_TRACE_IDS", "").split(",") if t],
+    "interval_ms": float(os.getenv("PROFILE_INTERVAL_MS", "5")),
+    # tracemalloc slows every allocation while on - only ever enabled during a profiled turn
+    "allocations": os.getenv("PROFILE_ALLOCATIONS", "true").lower() not in ("0", "false", "no"),
+}
+_settings_lock = threading.Lock()
+_control = {"mtime": None, "checked_at": 0.0}
+
+# The profile of the turn running in this context (propagated to timed-call threads by attach)
+_active = ContextVar("active_profile", default=None)
+
+
+def _validated(changes: dict) -> dict:
+    """Type-checked copy of settings changes (None values dropped); raises ValueError.
+    They can come from POST /profiling, so a bad value must never reach the turn path."""
+    unknown = set(changes) - set(_settings)
+    if unknown:
+        raise ValueError(f"Unknown profiling settings: {sorted(unknown)}")
+    valid = {}
+    for key, value in changes.items():
+        if value is None:
+            continue
+        if key in ("sample_rate", "interval_ms"):
+            try:
+                # bool is an int, but "true" is no rate
+                value = float(value) if not isinstance(value, bool) else math.nan
+            except (TypeError, ValueError):
+                value = math.nan
+            if not math.isfinite(value) or value < 0:
+                raise ValueError(f"{key} must be a non-negative number")
+            if key == "sample_rate" and value > 1:
+                raise ValueError("sample_rate must be between 0 and 1")
+            if key == "interval_ms" and value == 0:
+                raise ValueError("interval_ms must be greater than 0")
+        elif key == "trace_ids":
+            if not isinstance(value, list) or not all(isinstance(t, str) for t in value):
+                raise ValueError("trace_ids must be a list of strings")
+        elif key == "allocations" and not isinstance(value, bool):
+            raise ValueError("allocations must be true or false")
+        valid[key] = value
+    return valid
+
+
+def configure(**changes) -> dict:
+    """Change profiling settings for this process; returns the new settings"""
+    changes = _validated(changes)
+    with _settings_lock:
+        _settings.update(changes)
+        return dict(_settings)
+
+
+def get_settings() -> dict:
+    _refresh_from_control_file()
+    with _settings_lock:
+        return dict(_settings)
+
+
+def write_control_file(**changes) -> dict:
+    """Persist settings to the control file - picked up by every process within a second"""
+    changes = _validated(changes)
+    try:
+        with open(PROFILE_CONTROL_FILE) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        stored = {}
+    # Keep whatever in the file is still valid (it may have been edited by hand)
+    current = {}
+    for key, value in (stored.items() if isinstance(stored, dict) else ()):
+        try:
+            current.update(_validated({key: value}))
+        except ValueError:
+            print(f"Dropping invalid profiling setting {key!r} from the control file")
+    current.update(changes)
+    os.makedirs(os.path.dirname(PROFILE_CONTROL_FILE) or ".", exist_ok=True)
+    tmp_path = f"{PROFILE_CONTROL_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(current, f)
+    os.replace(tmp_path, PROFILE_CONTROL_FILE)
+    return current
+
+
+def _refresh_from_control_file():
+    now = time.monotonic()
+    if now - _control["checked_at"] < CONTROL_CHECK_SECONDS:
+        return
+    _control["checked_at"] = now
+    try:
+        mtime = os.stat(PROFILE_CONTROL_FILE).st_mtime
+    except OSError:
+        return
+    if mtime == _control["mtime"]:
+        return
+    _control["mtime"] = mtime
+    try:
+        with open(PROFILE_CONTROL_FILE) as f:
+            configure(**json.load(f))
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Error reading profiling control file: {e}")
+
+
+def should_profile(trace_id: str = None) -> bool:
+    settings = get_settings()
+    if trace_id and trace_id in settings["trace_ids"]:
+        return True
+    return settings["sample_rate"] > 0 and random.random() < settings["sample_rate"]
+
+
+def _file_safe(text: str) -> str:
+    """Trace ids come from clients and decisions from the LLM - keep them out of path syntax"""
+    return re.sub(r"[^A-Za-z0-9_-]", "_", text)[:64]
+
+
+# =============================================================================
+# SAMPLER
+# =============================================================================
+
+_labels = {}
+
+
+def _label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        path = code.co_filename.replace("\\", "/").split("/")
+        label = f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})".replace(";", ",")
+        _labels[code] = label
+    return label
+
+
+def _collapse(frame, thread_name: str) -> str:
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(_label(frame.f_code))
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ";".join(reversed(stack))
+
+
+class StackSampler:
+    """One background thread that samples the stacks of every thread registered to an active profile"""
+
+    def __init__(self):
+        self._profiles = set()
+        self._lock = threading.Condition()
+        self._thread = None
+
+    def add(self, profile: "TurnProfile"):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+            self._lock.notify()
+
+    def remove(self, profile: "TurnProfile"):
+        with self._lock:
+            self._profiles.discard(profile)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._profiles:
+                    self._lock.wait()
+                profiles = list(self._profiles)
+            frames = sys._current_frames()
+            for profile in profiles:
+                for thread_id, thread_name in profile.thread_snapshot():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.samples[_collapse(frame, thread_name)] += 1
+            del frames
+            time.sleep(_settings["interval_ms"] / 1000)
+
+
+sampler = StackSampler()
+
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+class TurnProfile:
+    """Samples, stage timings and allocation stats for one turn"""
+
+    def __init__(self, trace_id: str, allocations: bool):
+        self.trace_id = trace_id
+        self.decision = ""
+        self.stages = []
+        self.samples = Counter()
+        self.allocations = allocations
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._started = 0.0
+        self._elapsed = 0.0
+        self._alloc_stats = {}
+
+    def thread_snapshot(self) -> list:
+        with self._lock:
+            return [(thread_id, entry[0]) for thread_id, entry in self._threads.items()]
+
+    @contextmanager
+    def thread_scope(self):
+        """Sample the current thread while it does work for this turn"""
+        thread = threading.current_thread()
+        with self._lock:
+            entry = self._threads.setdefault(thread.ident, [thread.name, 0])
+            entry[1] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._threads.pop(thread.ident, None)
+
+    def record_stage(self, name: str, seconds: float):
+        with self._lock:
+            self.stages.append((name, round(seconds * 1000, 2)))
+
+    def start(self):
+        global _tracemalloc_users
+        if self.allocations:
+            with _tracemalloc_lock:
+                if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    tracemalloc.reset_peak()
+                _tracemalloc_users += 1
+        self._alloc_stats = {"blocks_before": sys.getallocatedblocks(),
+                             "gc_before": [stats["collections"] for stats in gc.get_stats()]}
+        self._started = time.perf_counter()
+        sampler.add(self)
+
+    def stop(self):
+        global _tracemalloc_users
+        self._elapsed = time.perf_counter() - self._started
+        sampler.remove(self)
+        stats = {
+            "allocated_blocks_delta": sys.getallocatedblocks() - self._alloc_stats["blocks_before"],
+            "gc_collections": [after - before for after, before in
+                               zip((s["collections"] for s in gc.get_stats()), self._alloc_stats["gc_before"])],
+        }
+        if self.allocations:
+            with _tracemalloc_lock:
+                if tracemalloc.is_tracing():
+                    # Shared with any other turn profiled at the same time
+                    snapshot = tracemalloc.take_snapshot().filter_traces([
+                        tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)])
+                    stats["traced_peak_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+                    stats["top_allocations"] = [
+                        {"where": str(stat.traceback), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+                    ]
+                _tracemalloc_users -= 1
+                if _tracemalloc_users == 0 and tracemalloc.is_tracing():
+                    tracemalloc.stop()
+        self._alloc_stats = stats
+
+    def write(self, directory: str = PROFILE_DIR) -> str:
+        """Write the .collapsed and .json files; returns their common path prefix"""
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%dT%H%M%S") + f"{time.time() % 1:.3f}"[1:]
+        prefix = os.path.join(directory, f"{stamp}-{_file_safe(self.decision) or 'none'}-{_file_safe(self.trace_id)}")
+        with open(prefix + ".collapsed", "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        stage_totals = Counter()
+        for name, ms in self.stages:
+            stage_totals[name] += ms
+        with open(prefix + ".json", "w") as f:
+            json.dump({
+                "trace_id": self.trace_id,
+                "decision": self.decision,
+                "total_ms": round(self._elapsed * 1000, 2),
+                "stages": [{"name": name, "ms": ms} for name, ms in self.stages],
+                "stage_totals_ms": {name: round(ms, 2) for name, ms in stage_totals.items()},
+                "samples": sum(self.samples.values()),
+                "interval_ms": _settings["interval_ms"],
+                "allocations": self._alloc_stats,
+            }, f, indent=2)
+        return prefix
+
+
+# =============================================================================
+# HOOKS
+# =============================================================================
+
+@contextmanager
+def profile_turn(trace_id: str = None):
+    """Profile the enclosed turn if it is sampled or its trace id is requested; yields the profile or None"""
+    if not should_profile(trace_id):
+        yield None
+        return
+    profile = TurnProfile(trace_id or uuid.uuid4().hex[:12], get_settings()["allocations"])
+    token = _active.set(profile)
+    profile.start()
+    try:
+        with profile.thread_scope():
+            yield profile
+    finally:
+        _active.reset(token)
+        profile.stop()
+        try:
+            profile.write()
+        except OSError as e:
+            print(f"Error writing turn profile: {e}")
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage of the current turn (no-op unless it is being profiled)"""
+    profile = _active.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    with profile.thread_scope():
+        try:
+            yield
+        finally:
+            profile.record_stage(name, time.perf_counter() - start)
+
+
+def timed_stage(name: str, fn):
+    """Wrap a graph node so profiled turns record its time"""
+    @wraps(fn)
+    def wrapper(state):
+        with stage(name):
+            return fn(state)
+    return wrapper
+
+
+def record_stage(name: str, seconds: float):
+    profile = _active.get()
+    if profile is not None:
+        profile.record_stage(name, seconds)
+
+
+def attach(fn):
+    """Carry the current turn's profile into a function run on another thread"""
+    profile = _active.get()
+    if profile is None:
+        return fn
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _active.set(profile)
+        try:
+            with profile.thread_scope():
+                return fn(*args, **kwargs)
+        finally:
+            _active.reset(token)
+    return wrapper
@@ -0,0 +1,287 @@
+"""
+Per-turn latency budget, timeouts, hedged requests and circuit breakers for external calls
+"""
+import os, time, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dotenv import load_dotenv
+from .profiling import attach, record_stage
+
+load_dotenv()
+
+TURN_BUDGET_SECONDS = float(os.getenv("TURN_BUDGET_SECONDS", "25"))
+# Never hedge sooner than this, even if the observed p95 is tiny
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "0.05"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+
+class DependencyUnavailableError(RuntimeError):
+    """A dependency was skipped or gave up - callers should degrade instead of failing the turn"""
+
+
+class DeadlineExceededError(DependencyUnavailableError):
+    """The turn's latency budget ran out before or during a call"""
+
+
+class CircuitOpenError(DependencyUnavailableError):
+    """The dependency's circuit breaker is open"""
+
+
+_metrics_lock = threading.Lock()
+metrics = {
+    "budget_exhausted": 0,   # calls refused because the turn had no time left
+    "turns_over_budget": 0,
+    "timeouts": {},          # per dependency
+    "hedges_fired": 0,
+    "hedge_wins": 0,
+    "breaker_opens": {},     # per dependency
+    "breaker_skips": {},     # per dependency
+}
+
+
+def _bump(name: str, dependency: str = None):
+    with _metrics_lock:
+        if dependency is None:
+            metrics[name] += 1
+        else:
+            metrics[name][dependency] = metrics[name].get(dependency, 0) + 1
+
+
+class Deadline:
+    """Absolute deadline for one turn, passed down to every tool"""
+
+    def __init__(self, budget_seconds: float = TURN_BUDGET_SECONDS):
+        self.budget_seconds = budget_seconds
+        self.expires_at = time.monotonic() + budget_seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def spent(self) -> bool:
+        """Like expired(), but counts a call skipped for lack of budget in budget_exhausted"""
+        if self.expired():
+            _bump("budget_exhausted")
+            return True
+        return False
+
+    def timeout(self, cap: float = None) -> float:
+        """Seconds the next call may take; raises if the budget is already spent"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            _bump("budget_exhausted")
+            raise DeadlineExceededError("Turn latency budget exhausted")
+        return remaining if cap is None else min(remaining, cap)
+
+
+def record_turn(deadline: Deadline):
+    """Count turns that finished past their budget"""
+    if deadline.expired():
+        _bump("turns_over_budget")
+
+
+def ensure_deadline(deadline: Deadline = None) -> Deadline:
+    """Tools called outside a graph turn get a fresh full budget"""
+    return deadline if deadline is not None else Deadline()
+
+
+# Worker threads for timed calls, one bounded pool per dependency so a slow Gemini can't starve
+# the Supabase RPCs. A timed-out call keeps its thread until the underlying client returns;
+# calls still queued when their turn gives up are cancelled.
+POOL_THREADS = {"llm": int(os.getenv("LLM_POOL_THREADS", "64"))}
+DEFAULT_POOL_THREADS = int(os.getenv("RESILIENCE_POOL_THREADS", "16"))
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _executor(dependency: str) -> ThreadPoolExecutor:
+    with _executors_lock:
+        executor = _executors.get(dependency)
+        if executor is None:
+            executor = _executors[dependency] = ThreadPoolExecutor(
+                max_workers=POOL_THREADS.get(dependency, DEFAULT_POOL_THREADS),
+                thread_name_prefix=f"timed-{dependency}")
+        return executor
+
+
+class LatencyTracker:
+    """Rolling window of recent latencies for one dependency"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float):
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+latencies = {}
+
+
+def _tracker(dependency: str) -> LatencyTracker:
+    tracker = latencies.get(dependency)
+    if tracker is None:
+        tracker = latencies.setdefault(dependency, LatencyTracker())
+    return tracker
+
+
+def _timed(dependency: str, fn, *args, **kwargs):
+    start = time.monotonic()
+    result = fn(*args, **kwargs)
+    elapsed = time.monotonic() - start
+    _tracker(dependency).record(elapsed)
+    record_stage(dependency, elapsed)
+    return result
+
+
+def call_with_timeout(dependency: str, fn, deadline: Deadline, *args, cap: float = None,
+                      on_done=None, **kwargs):
+    """Run fn on the dependency's worker pool and give up once the deadline (or cap) passes.
+    on_done(future) runs once the call really finishes or is cancelled, even after a timeout -
+    or with None if the budget was already spent and it never started."""
+    try:
+        timeout = deadline.timeout(cap)
+    except DeadlineExceededError:
+        if on_done is not None:
+            on_done(None)
+        raise
+    future = _executor(dependency).submit(attach(_timed), dependency, fn, *args, **kwargs)
+    if on_done is not None:
+        future.add_done_callback(on_done)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # Drops it from the queue if it never started; a running call can't be interrupted
+        future.cancel()
+        _bump("timeouts", dependency)
+        raise DeadlineExceededError(f"{dependency} call timed out after {timeout:.2f}s")
+
+
+def hedged_call(dependency: str, fn, deadline: Deadline, *args, **kwargs):
+    """Run fn; if it is still running past the dependency's p95, fire a duplicate and take the first result"""
+    timeout = deadline.timeout()
+    executor = _executor(dependency)
+    primary = executor.submit(attach(_timed), dependency, fn, *args, **kwargs)
+
+    p95 = _tracker(dependency).percentile(0.95)
+    hedge_after = None if p95 is None else max(p95, HEDGE_MIN_DELAY_SECONDS)
+    if hedge_after is None or hedge_after >= timeout:
+        try:
+            return primary.result(timeout=timeout)
+        except FutureTimeoutError:
+            primary.cancel()
+            _bump("timeouts", dependency)
+            raise DeadlineExceededError(f"{dependency} call timed out after {timeout:.2f}s")
+
+    done, _ = wait([primary], timeout=hedge_after)
+    if done:
+        return primary.result()
+
+    _bump("hedges_fired")
+    hedge = executor.submit(attach(_timed), dependency, fn, *args, **kwargs)
+    pending = {primary, hedge}
+    last_error = None
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        _bump("hedge_wins")
+                    return future.result()
+                last_error = future.exception()
+        if last_error is not None and not pending:
+            raise last_error
+        _bump("timeouts", dependency)
+        raise DeadlineExceededError(f"{dependency} call and its hedge timed out")
+    finally:
+        # Whatever lost (or is still queued) is no longer wanted
+        for future in pending:
+            future.cancel()
+
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failures -> half-open trial after a cool-down"""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go through; open breakers let one trial call through after the cool-down"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                if now - self.opened_at < self.reset_seconds:
+                    _bump("breaker_skips", self.name)
+                    return False
+                self.state = "half_open"
+                self.trial_started_at = now
+                return True
+            if self.state == "half_open":
+                # A trial call is in flight - unless it never reported back (its caller raised
+                # before record_success/record_failure), then it's time for another one
+                if now - self.trial_started_at < self.reset_seconds:
+                    _bump("breaker_skips", self.name)
+                    return False
+                self.trial_started_at = now
+                return True
+            return True
+
+    def check(self):
+        """Raise CircuitOpenError instead of returning False"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    _bump("breaker_opens", self.name)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+breakers = {
+    "memory": CircuitBreaker("memory"),
+    "kb": CircuitBreaker("kb"),
+    "llm": CircuitBreaker("llm"),
+    "slack": CircuitBreaker("slack"),
+}
+
+
+def get_resilience_stats() -> dict:
+    """Budget, timeout, hedge and breaker counters plus current p95 per dependency"""
+    with _metrics_lock:
+        stats = {k: (dict(v) if isinstance(v, dict) else v) for k, v in metrics.items()}
+    stats["breaker_states"] = {name: b.state for name, b in breakers.items()}
+    stats["p95_seconds"] = {name: t.percentile(0.95) for name, t in list(latencies.items())}
+    return stats
@@ -0,0 +1,193 @@
+"""
+Retrieval result cache keyed on a locality-sensitive hash of the query embedding.
+Holds positive and negative results (top-k refs and scores only) and is invalidated by
+KB / memory version counters that ingestion and semantic memory upserts bump.
+"""
+import os, time, threading
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+from db.db import supabase_client
+from .resilience import Deadline, call_with_timeout
+
+load_dotenv()
+
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+RETRIEVAL_CACHE_MAX_BUCKETS = int(os.getenv("RETRIEVAL_CACHE_MAX_BUCKETS", "10000"))
+# LSH only picks the bucket - a hit still needs this cosine to the cached query
+RETRIEVAL_CACHE_MIN_SIMILARITY = float(os.getenv("RETRIEVAL_CACHE_MIN_SIMILARITY", "0.97"))
+RETRIEVAL_CACHE_HASH_BITS = int(os.getenv("RETRIEVAL_CACHE_HASH_BITS", "16"))
+RETRIEVAL_VERSION_REFRESH_SECONDS = float(os.getenv("RETRIEVAL_VERSION_REFRESH_SECONDS", "10"))
+RETRIEVAL_VERSION_RPC_TIMEOUT_SECONDS = float(os.getenv("RETRIEVAL_VERSION_RPC_TIMEOUT_SECONDS", "3"))
+EMBEDDING_DIMENSIONS = 768
+ENTRIES_PER_BUCKET = 8
+
+
+class VersionCounters:
+    """KB / memory versions: shared counter in Postgres plus a local epoch bumped immediately.
+    Both RPCs run on background threads - lookups and upserts never wait for the database."""
+
+    def __init__(self):
+        self._db = {"kb": 0, "memory": 0}
+        self._epoch = {"kb": 0, "memory": 0}
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        # Kinds whose shared counter still has to be bumped - several bumps coalesce into one RPC
+        self._pending = set()
+        self._bumped = threading.Condition(self._lock)
+        self._bumping = False
+
+    def _maybe_refresh(self):
+        with self._lock:
+            if self._refreshing or time.monotonic() - self._refreshed_at < RETRIEVAL_VERSION_REFRESH_SECONDS:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="retrieval-versions", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            response = call_with_timeout(
+                "retrieval_versions",
+                lambda: supabase_client.rpc("get_retrieval_versions", {}).execute(),
+                Deadline(RETRIEVAL_VERSION_RPC_TIMEOUT_SECONDS)
+            )
+            rows = getattr(response, "data", None) or []
+            with self._lock:
+                for row in rows:
+                    if row.get("name") in self._db:
+                        self._db[row["name"]] = row["version"]
+        except Exception as e:
+            print(f"Error refreshing retrieval versions: {e}")
+        finally:
+            with self._lock:
+                self._refreshed_at = time.monotonic()
+                self._refreshing = False
+
+    def current(self, kind: str) -> tuple:
+        """(shared version, local epoch) - cached entries are valid only for an exact match"""
+        self._maybe_refresh()
+        with self._lock:
+            return self._db[kind], self._epoch[kind]
+
+    def bump(self, kind: str, wait: bool = False):
+        """Invalidate cached results of this kind here at once, and in other workers on their next refresh.
+        The shared counter is bumped in the background unless wait is set (e.g. at the end of a script)."""
+        with self._lock:
+            # The epoch never goes back, so entries cached before the bump can't revalidate
+            self._epoch[kind] += 1
+            self._pending.add(kind)
+            if not self._bumping:
+                self._bumping = True
+                threading.Thread(target=self._bump_shared, name="retrieval-version-bump", daemon=True).start()
+            if wait:
+                self._bumped.wait_for(lambda: kind not in self._pending and not self._bumping,
+                                      timeout=RETRIEVAL_VERSION_RPC_TIMEOUT_SECONDS * 2)
+
+    def _bump_shared(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._bumping = False
+                    self._bumped.notify_all()
+                    return
+                kind = self._pending.pop()
+            try:
+                version = getattr(call_with_timeout(
+                    "retrieval_versions",
+                    lambda: supabase_client.rpc("bump_retrieval_version", {"version_name": kind}).execute(),
+                    Deadline(RETRIEVAL_VERSION_RPC_TIMEOUT_SECONDS)
+                ), "data", None)
+                if isinstance(version, int):
+                    with self._lock:
+                        self._db[kind] = max(self._db[kind], version)
+            except Exception as e:
+                print(f"Error bumping {kind} retrieval version: {e}")
+
+
+class RetrievalCache:
+    """LRU of LSH buckets; each bucket holds a few (query vector, result, version) entries"""
+
+    def __init__(self, versions: VersionCounters, max_buckets: int = RETRIEVAL_CACHE_MAX_BUCKETS):
+        self.versions = versions
+        self.max_buckets = max_buckets
+        # Fixed seed so every worker hashes the same query to the same bucket
+        self._planes = np.random.default_rng(768).standard_normal(
+            (RETRIEVAL_CACHE_HASH_BITS, EMBEDDING_DIMENSIONS)).astype(np.float32)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {kind: {"hits": 0, "positive_hits": 0, "negative_hits": 0, "misses": 0, "stale": 0}
+                      for kind in ("memory", "kb")}
+
+    def _bucket(self, kind: str, signature: str, vec: np.ndarray) -> tuple:
+        # SimHash: which side of each random hyperplane the query falls on
+        bits = (self._planes @ vec) > 0
+        return kind, signature, np.packbits(bits).tobytes()
+
+    def get(self, kind: str, signature: str, query_vec: list):
+        """Cached result for a near-identical query, or None"""
+        if not RETRIEVAL_CACHE_ENABLED:
+            return None
+        vec = np.asarray(query_vec, dtype=np.float32)
+        key = self._bucket(kind, signature, vec)
+        version = self.versions.current(kind)
+        stats = self.stats[kind]
+        with self._lock:
+            entries = self._buckets.get(key)
+            if entries:
+                self._buckets.move_to_end(key)
+                # Drop entries from an older KB / memory version
+                fresh = [entry for entry in entries if entry[2] == version]
+                if len(fresh) < len(entries):
+                    stats["stale"] += len(entries) - len(fresh)
+                    self._buckets[key] = fresh
+                for cached_vec, result, _ in fresh:
+                    if float(cached_vec @ vec) >= RETRIEVAL_CACHE_MIN_SIMILARITY:
+                        stats["hits"] += 1
+                        stats["positive_hits" if result.found else "negative_hits"] += 1
+                        return result
+            stats["misses"] += 1
+            return None
+
+    def version(self, kind: str) -> tuple:
+        """Read before a retrieval starts and pass to set() with its result"""
+        return self.versions.current(kind)
+
+    def set(self, kind: str, signature: str, query_vec: list, result, version: tuple):
+        """Remember a successful retrieval (found or not) for this query. version must be read
+        before the retrieval started: a bump while it ran then leaves the entry already stale,
+        instead of tagging a pre-bump result with the new version."""
+        if not RETRIEVAL_CACHE_ENABLED:
+            return
+        vec = np.asarray(query_vec, dtype=np.float32)
+        key = self._bucket(kind, signature, vec)
+        with self._lock:
+            entries = self._buckets.setdefault(key, [])
+            entries.insert(0, (vec, result, version))
+            del entries[ENTRIES_PER_BUCKET:]
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = {kind: dict(values) for kind, values in self.stats.items()}
+        for values in stats.values():
+            lookups = values["hits"] + values["misses"]
+            values["hit_rate"] = round(values["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+retrieval_versions = VersionCounters()
+retrieval_cache = RetrievalCache(retrieval_versions)
+
+
+def bump_retrieval_version(kind: str, wait: bool = False):
+    """Call after changing the KB ("kb") or qa_memory ("memory"); wait for the shared bump when
+    the process may exit right after"""
+    retrieval_versions.bump(kind, wait)
+
+
+def get_retrieval_cache_stats() -> dict:
+    """Hit rates (positive and negative) for memory and KB separately"""
+    return retrieval_cache.get_stats()
@@ -0,0 +1,94 @@
+"""
+KB section classifier - narrows knowledge base search to one metadata partition
+"""
+import os, json, math, time, threading
+from typing import Optional
+from dotenv import load_dotenv
+from db.db import supabase_client
+from .resilience import Deadline, call_with_timeout
+
+load_dotenv()
+
+KB_SECTION_ROUTING = os.getenv("KB_SECTION_ROUTING", "true").lower() not in ("0", "false", "no")
+# Query must be this close to the best section centroid...
+SECTION_MIN_SIMILARITY = float(os.getenv("SECTION_MIN_SIMILARITY", "0.35"))
+# ...and clearly closer to it than to the runner-up, otherwise search the whole KB
+SECTION_MIN_MARGIN = float(os.getenv("SECTION_MIN_MARGIN", "0.05"))
+SECTION_REFRESH_SECONDS = float(os.getenv("SECTION_REFRESH_SECONDS", "600"))
+SECTION_RPC_TIMEOUT_SECONDS = float(os.getenv("SECTION_RPC_TIMEOUT_SECONDS", "3"))
+# Retry sooner when the last load failed or found no sections
+SECTION_RETRY_SECONDS = 30.0
+
+_centroids = {}
+_loaded_at = 0.0
+_refreshing = False
+_lock = threading.Lock()
+
+
+def _parse_vector(value) -> list:
+    """pgvector values come back from PostgREST as '[0.1,0.2,...]' strings"""
+    return json.loads(value) if isinstance(value, str) else list(value)
+
+
+def _normalize(vec: list) -> list:
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+
+def _fetch_centroids():
+    """Run the RPC (never under _lock) and swap in the result; failures keep the old centroids"""
+    global _centroids, _loaded_at, _refreshing
+    centroids = None
+    try:
+        response = call_with_timeout(
+            "kb_section_centroids",
+            lambda: supabase_client.rpc("kb_section_centroids", {}).execute(),
+            Deadline(SECTION_RPC_TIMEOUT_SECONDS)
+        )
+        rows = getattr(response, "data", None) or []
+        centroids = {row["section"]: _normalize(_parse_vector(row["centroid"]))
+                     for row in rows if row.get("section") and row.get("centroid")}
+    except Exception as e:
+        print(f"Error loading KB section centroids: {e}")
+    with _lock:
+        if centroids is not None:
+            _centroids = centroids
+        # Also throttles retries when the RPC fails
+        _loaded_at = time.monotonic()
+        _refreshing = False
+
+
+def load_section_centroids(force: bool = False) -> dict:
+    """Return the cached normalized centroid of every KB section. Stale centroids are refreshed
+    in the background and keep being served meanwhile; only the very first load (or force) waits."""
+    global _refreshing
+    with _lock:
+        max_age = SECTION_REFRESH_SECONDS if _centroids else SECTION_RETRY_SECONDS
+        fresh = _loaded_at and time.monotonic() - _loaded_at < max_age
+        if (fresh and not force) or _refreshing:
+            return _centroids
+        _refreshing = True
+        background = bool(_loaded_at) and not force
+    if background:
+        threading.Thread(target=_fetch_centroids, name="section-centroids", daemon=True).start()
+    else:
+        _fetch_centroids()
+    return _centroids
+
+
+def classify_section(query_vec: list) -> Optional[str]:
+    """Return the KB section a (normalized) query embedding clearly belongs to, or None"""
+    if not KB_SECTION_ROUTING:
+        return None
+    centroids = load_section_centroids()
+    if len(centroids) < 2:
+        return None
+
+    scored = sorted(
+        ((sum(q * c for q, c in zip(query_vec, centroid)), section) for section, centroid in centroids.items()),
+        reverse=True
+    )
+    (best_score, best_section), (runner_up_score, _) = scored[0], scored[1]
+    if best_score >= SECTION_MIN_SIMILARITY and best_score - runner_up_score >= SECTION_MIN_MARGIN:
+        return best_section
+    return None
@@ -1,6 +1,7 @@
-from .memory import semantic_memory_lookup, semantic_memory_upsert, search_knowledge_base_internal
+from .memory import search_memory_and_kb
 from .models import Answer, ConversationState
-from concurrent.futures import ThreadPoolExecutor
+from .llm_cache import CachedLLM
+from .resilience import Deadline, DependencyUnavailableError
 import os
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -9,34 +10,31 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # LLM for answering
-llm = ChatGoogleGenerativeAI(
+llm = CachedLLM(ChatGoogleGenerativeAI(
     model="gemini-2.0-flash-lite",
     google_api_key=os.getenv("GEMINI_API_KEY"),
     temperature=0.2,
     max_output_tokens=500,
-)
+))
 
 # Agent Decision LLM - for smart routing
-agent_llm = ChatGoogleGenerativeAI(
+agent_llm = CachedLLM(ChatGoogleGenerativeAI(
     model="gemini-2.0-flash-lite",
     google_api_key=os.getenv("GEMINI_API_KEY"),
     temperature=0.1,
     max_output_tokens=200,
-)
+))
 
+# Returned when an answer call is shed, times out or hits an open breaker and there's nothing to fall back on
+LLM_BUSY_MESSAGE = ("I'm having trouble generating an answer right now. "
+                    "Please try again in a moment.")
 
-def query_tools_parallel(query: str) -> tuple[Answer, Answer]:
-    """Query Memory and Knowledge Base in parallel - only fetch chunks"""
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        # Submit both queries simultaneously
-        memory_future = executor.submit(semantic_memory_lookup, query)
-        kb_future = executor.submit(search_knowledge_base_internal, query)
-        
-        # Get results
-        memory_result = memory_future.result()
-        kb_result = kb_future.result()
-        
-        return memory_result, kb_result
+
+def query_tools_parallel(query: str, deadline: Deadline = None, query_vec: list = None,
+                         prior_candidates: list = None) -> tuple[Answer, Answer]:
+    """Query Memory and Knowledge Base together - one combined RPC, only fetch chunks"""
+    return search_memory_and_kb(query, deadline=deadline, query_vec=query_vec,
+                                prior_candidates=prior_candidates)
 
 def process_tool_results(state: ConversationState, memory_result: Answer, kb_result: Answer) -> ConversationState:
     """Process and update state with tool results - NO LLM processing here"""
@@ -47,7 +45,7 @@ def process_tool_results(state: ConversationState, memory_result: Answer, kb_res
     
     return state
 
-def answer_with_llm(question: str, context: str) -> str:
+def answer_with_llm(question: str, context: str, use_cache: bool = True, deadline: Deadline = None) -> str:
     """Use LLM to answer question with context - returns CANNOT_ANSWER if context is insufficient"""
     prompt = ChatPromptTemplate.from_messages([
         ("system", """You are a BeWhoop Assistant. BeWhoop is a social platform that connects vendors with event organizers and event seekersq with their favourite genre events, providing services for event seekers, vendor registration, event management, and facility of booking events for event seekers with ease.
@@ -67,9 +65,9 @@ def answer_with_llm(question: str, context: str) -> str:
         ("human", "Question: {question}\n\nContext: {context}\n\nPlease respond:")
         ])
     
-    chain = prompt | llm
-    response = chain.invoke({"question": question, "context": context})
-    return response.content.strip()
+    prompt_value = prompt.invoke({"question": question, "context": context})
+    response = llm.invoke(prompt_value, use_cache=use_cache, deadline=deadline)
+    return response.strip()
 
 def is_escalation_request(user_input: str) -> bool:
     """Check if user is specifically requesting escalation"""
@@ -100,12 +98,13 @@ def reset_conversation() -> ConversationState:
     return ConversationState()
 
 def is_waiting_for_clarification(conversation_state: ConversationState, max_attempts: int = 1) -> bool:
-    """Check if we're in a clarification state"""
-    return (conversation_state.clarification_attempts > 0 and 
-            conversation_state.clarification_attempts < max_attempts and
+    """Check if we asked for clarification and the user's reply is next
+    (run_turn resets the attempts once a turn ends without asking)"""
+    return (0 < conversation_state.clarification_attempts <= max_attempts and
             not conversation_state.escalation_needed)
 
-def make_agent_decision(question: str, is_clarification: bool, clarification_attempts: int) -> str:
+def make_agent_decision(question: str, is_clarification: bool, clarification_attempts: int,
+                        use_cache: bool = True, deadline: Deadline = None) -> str:
     """Intelligent agent that decides which tools to use"""
     decision_prompt = ChatPromptTemplate.from_messages([
         ("system", """You are a smart routing agent for a BeWhoop support system. Analyze the user's question and decide the best approach.
@@ -133,12 +132,17 @@ def make_agent_decision(question: str, is_clarification: bool, clarification_att
         ("human", "Question: {question}")
     ])
     
-    chain = decision_prompt | agent_llm
     context_type = "clarification attempt" if is_clarification else "new question"
-    decision = chain.invoke({
+    prompt_value = decision_prompt.invoke({
         "question": question, 
         "context_type": context_type,
         "attempts": clarification_attempts
-    }).content.strip().lower()
+    })
+    try:
+        decision = agent_llm.invoke(prompt_value, use_cache=use_cache, deadline=deadline).strip().lower()
+    except DependencyUnavailableError as e:
+        # Skip routing under load or when the LLM is failing - searching both is the safe default
+        print(f"DEBUG: Routing LLM unavailable ({e}), defaulting to need_both")
+        decision = "need_both"
     
     return decision 
\ No newline at end of file
@@ -9,6 +9,8 @@ CREATE TABLE documents (
 );
 
 -- Vector Similarity Search Function
+-- filter is matched with metadata @> filter, e.g. {"section": "Ticketing & Payments"}.
+-- A section filter is inlined as a literal so the planner can pick that section's partial index.
 CREATE OR REPLACE FUNCTION match_documents(
   query_embedding vector(768),
   match_count int DEFAULT NULL,
@@ -23,6 +25,18 @@ LANGUAGE plpgsql
 AS $$
 #variable_conflict use_column
 BEGIN
+  IF filter IS NOT NULL AND filter ? 'section' THEN
+    RETURN QUERY EXECUTE format(
+      'SELECT id, content, metadata, 1 - (embedding <=> $1) AS similarity
+       FROM documents
+       WHERE metadata->>''section'' = %L AND metadata @> $2
+       ORDER BY embedding <=> $1
+       LIMIT $3',
+      filter->>'section'
+    ) USING query_embedding, filter, match_count;
+    RETURN;
+  END IF;
+
   RETURN QUERY
   SELECT
     id,
@@ -30,7 +44,7 @@ BEGIN
     metadata,
     1 - (documents.embedding <=> query_embedding) AS similarity
   FROM documents
-  WHERE 1 = 1
+  WHERE filter IS NULL OR documents.metadata @> filter
   ORDER BY documents.embedding <=> query_embedding
   LIMIT match_count;
 END;
@@ -39,6 +53,98 @@ $$;
 -- Vector Search Index with IVFFlat
 CREATE INDEX ON documents USING ivfflat (embedding vector_l2_ops) WITH (lists = 100);
 
+-- Metadata filters (section, tags, audience)
+CREATE INDEX IF NOT EXISTS documents_metadata_idx ON documents USING gin (metadata jsonb_path_ops);
+
+-- One partial vector index per KB section (loader.py calls this after ingestion).
+-- Small sections are skipped - an exact scan of a few hundred rows beats an ivfflat probe.
+CREATE OR REPLACE FUNCTION create_kb_section_indexes(min_rows int DEFAULT 1000)
+RETURNS TABLE (section TEXT, chunk_count BIGINT, index_name TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  s RECORD;
+  idx TEXT;
+BEGIN
+  FOR s IN
+    SELECT documents.metadata->>'section' AS name, count(*) AS n
+    FROM documents
+    WHERE documents.metadata ? 'section'
+    GROUP BY 1
+  LOOP
+    idx := NULL;
+    IF s.n >= min_rows THEN
+      idx := 'documents_section_' || substr(md5(s.name), 1, 12) || '_idx';
+      EXECUTE format(
+        'CREATE INDEX IF NOT EXISTS %I ON documents USING ivfflat (embedding vector_cosine_ops)
+         WITH (lists = %s) WHERE metadata->>''section'' = %L',
+        idx, greatest(1, (s.n / 1000)::int), s.name
+      );
+    END IF;
+    section := s.name;
+    chunk_count := s.n;
+    index_name := idx;
+    RETURN NEXT;
+  END LOOP;
+END;
+$$;
+
+-- Parent sections for heading-aware chunking (loader.py): documents holds small child chunks
+-- with metadata.parent_id, this holds the whole KB section each child was cut from
+CREATE TABLE IF NOT EXISTS kb_sections (
+    id TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    metadata JSONB
+);
+
+CREATE INDEX IF NOT EXISTS documents_parent_id_idx ON documents ((metadata->>'parent_id'));
+
+-- Best-matching child chunks, de-duplicated to one row per parent section and returned as
+-- that section. Chunks without a parent_id (fixed-size chunking) are returned as themselves.
+CREATE OR REPLACE FUNCTION match_document_sections(
+  query_embedding vector(768),
+  match_count int DEFAULT 3,
+  filter JSONB DEFAULT NULL,
+  candidate_count int DEFAULT 24
+) RETURNS TABLE (
+  id TEXT,
+  content TEXT,
+  metadata JSONB,
+  similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+  WITH hits AS (
+    SELECT coalesce(h.metadata->>'parent_id', h.id::text) AS parent_key, h.*
+    FROM match_documents(query_embedding, candidate_count, filter) h
+  ),
+  best AS (
+    -- A section's score is its best child's
+    SELECT DISTINCT ON (parent_key) *
+    FROM hits
+    ORDER BY parent_key, similarity DESC
+  )
+  SELECT
+    coalesce(p.id, best.id::text),
+    coalesce(p.content, best.content),
+    coalesce(p.metadata, best.metadata),
+    best.similarity
+  FROM best
+  LEFT JOIN kb_sections p ON p.id = best.metadata->>'parent_id'
+  ORDER BY best.similarity DESC
+  LIMIT match_count;
+$$;
+
+-- Per-section centroid of chunk embeddings, used client-side to route a query to one section
+CREATE OR REPLACE FUNCTION kb_section_centroids()
+RETURNS TABLE (section TEXT, centroid vector(768), chunk_count BIGINT)
+LANGUAGE sql STABLE AS $$
+  SELECT metadata->>'section', avg(embedding), count(*)
+  FROM documents
+  WHERE metadata ? 'section'
+  GROUP BY 1;
+$$;
+
 
 -- 768 dims for all-mpnet-base-v2
 create table if not exists qa_memory (
@@ -49,6 +155,13 @@ create table if not exists qa_memory (
   created_at timestamptz not null default now()
 );
 
+-- Provenance for pre-warmed answers (warmup.py): kb_key identifies the KB question the
+-- answer came from, kb_version is a hash of that question's text at warm-up time
+alter table qa_memory add column if not exists source text not null default 'user';
+alter table qa_memory add column if not exists kb_key text;
+alter table qa_memory add column if not exists kb_version text;
+create index if not exists qa_memory_kb_key_idx on qa_memory (kb_key) where kb_key is not null;
+
 -- Cosine index (requires normalized vectors)
 create index if not exists qa_memory_q_embedding_idx
 on qa_memory using ivfflat (q_embedding vector_cosine_ops) with (lists = 100);
@@ -76,3 +189,58 @@ language sql stable as $$
   order by similarity desc
   limit match_count;
 $$;
+
+
+-- Version counters for client-side retrieval caches (core/retrieval_cache.py).
+-- Ingestion bumps 'kb', qa_memory writes bump 'memory'; workers poll get_retrieval_versions.
+create table if not exists retrieval_versions (
+  name text primary key,
+  version bigint not null default 0
+);
+insert into retrieval_versions (name) values ('kb'), ('memory') on conflict do nothing;
+
+create or replace function bump_retrieval_version(version_name text)
+returns bigint
+language sql as $$
+  insert into retrieval_versions (name, version) values (version_name, 1)
+  on conflict (name) do update set version = retrieval_versions.version + 1
+  returning version;
+$$;
+
+create or replace function get_retrieval_versions()
+returns table (name text, version bigint)
+language sql stable as $$
+  select name, version from retrieval_versions;
+$$;
+
+
+-- Memory candidates and KB chunks for one query embedding in a single round trip.
+-- query_embedding can be sent as compact pgvector text ('[0.012,...]') instead of a JSON array.
+-- parent_sections returns whole KB sections (match_document_sections) instead of raw chunks.
+drop function if exists match_memory_and_documents(vector, float, int, int, jsonb);
+create or replace function match_memory_and_documents(
+  query_embedding vector(768),
+  match_threshold float default 0.82,
+  memory_count int default 1,
+  kb_count int default 3,
+  filter jsonb default null,
+  parent_sections boolean default true
+)
+returns jsonb
+language sql stable as $$
+  select jsonb_build_object(
+    'memory', coalesce(
+      (select jsonb_agg(to_jsonb(m) order by m.similarity desc)
+       from match_qa_memory(query_embedding, match_threshold, memory_count) m),
+      '[]'::jsonb),
+    'documents', coalesce(
+      case when parent_sections then
+        (select jsonb_agg(to_jsonb(d) order by d.similarity desc)
+         from match_document_sections(query_embedding, kb_count, filter) d)
+      else
+        (select jsonb_agg(to_jsonb(d) order by d.similarity desc)
+         from match_documents(query_embedding, kb_count, filter) d)
+      end,
+      '[]'::jsonb)
+  );
+$$;
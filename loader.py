@@ -1,47 +1,261 @@
+import re, hashlib, uuid
 from langchain_community.document_loaders import NotionDirectoryLoader
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import SupabaseVectorStore
-from db import supabase_client
+from db.db import supabase_client
 
+# Questions under the export's title heading (before any topic heading) land here
+DEFAULT_SECTION = "General"
+# qa_memory rows generated by warmup.py
+WARMUP_SOURCE = "warmup"
+# Parent sections are what the LLM sees; small children are what gets embedded and matched
+PARENT_MAX_CHARS = 2000
+CHILD_CHUNK_SIZE = 200
+CHILD_CHUNK_OVERLAP = 20
+
+
+def _clean_heading(line: str) -> str:
+    """'# **Vendor Visibility**' -> 'Vendor Visibility'"""
+    return line.lstrip("#").strip().strip("*").strip()
+
+
+def split_by_headings(doc: Document) -> list[Document]:
+    """Split one Notion page into one Document per question, tagged with its topic section"""
+    lines = doc.page_content.splitlines()
+    title = _clean_heading(lines[0]) if lines and lines[0].startswith("# ") else None
+
+    sections = []
+    section = DEFAULT_SECTION
+    current = None
+
+    def flush():
+        if current and "\n".join(current["lines"]).strip():
+            metadata = dict(doc.metadata)
+            metadata.update({
+                "section": current["section"],
+                "question": current["question"],
+                "audience": current["audience"],
+                "tags": current["tags"],
+            })
+            sections.append(Document(page_content="\n".join(current["lines"]).strip(), metadata=metadata))
+
+    for line in lines:
+        stripped = line.strip()
+        if line.startswith("# "):
+            # Topic heading - everything until the next one belongs to this section
+            flush()
+            current = None
+            heading = _clean_heading(line)
+            section = DEFAULT_SECTION if heading == title else heading
+        elif line.startswith("##"):
+            # Question heading (## or ###) starts a new chunk
+            flush()
+            current = {"section": section, "question": _clean_heading(line),
+                       "audience": "", "tags": [], "lines": [line]}
+        elif current is not None:
+            if stripped == "---":
+                continue
+            audience = re.match(r"\*\*Audience\*\*:\s*(.*)", stripped)
+            tags = re.match(r"\*\*Tags\*\*:\s*(.*)", stripped)
+            if audience:
+                current["audience"] = audience.group(1).strip()
+            elif tags:
+                current["tags"] = [t.strip() for t in tags.group(1).split(",") if t.strip()]
+            current["lines"].append(line)
+    flush()
+    return sections
+
+
+def load_kb_sections(path: str = "notion_export/") -> list[Document]:
+    """Load the Notion export as one tagged Document per KB question"""
+    loader = NotionDirectoryLoader(path)
+    return [section_doc for doc in loader.load() for section_doc in split_by_headings(doc)]
+
+
+def kb_key(doc) -> str:
+    """Stable id of a KB question: its section and heading"""
+    return f"{doc.metadata.get('section', '')}::{doc.metadata.get('question', '')}"
+
+
+def kb_version(doc) -> str:
+    """Changes whenever the KB question's text changes"""
+    return hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()[:16]
+
+
+def warmed_versions() -> dict:
+    """kb_key -> set of kb_versions already warmed in qa_memory"""
+    versions, start, page = {}, 0, 1000
+    while True:
+        # PostgREST caps a response at 1000 rows
+        response = (supabase_client.table("qa_memory").select("kb_key, kb_version")
+                    .eq("source", WARMUP_SOURCE).order("id").range(start, start + page - 1).execute())
+        rows = getattr(response, "data", None) or []
+        for row in rows:
+            versions.setdefault(row["kb_key"], set()).add(row["kb_version"])
+        if len(rows) < page:
+            return versions
+        start += page
+
+
+def invalidate_warmed(key: str, keep_version: str = None):
+    """Delete warmed answers for a KB question, except any generated from keep_version"""
+    query = supabase_client.table("qa_memory").delete().eq("source", WARMUP_SOURCE).eq("kb_key", key)
+    if keep_version is not None:
+        query = query.neq("kb_version", keep_version)
+    query.execute()
+
+
+def invalidate_stale_warmup(tagged_docs: list[Document]) -> int:
+    """Drop warmed answers whose KB question changed or disappeared, so qa_memory never serves
+    an answer generated from old KB text. Returns the number of KB questions affected"""
+    current = {kb_key(doc): kb_version(doc) for doc in tagged_docs}
+    affected = 0
+    for key, versions in warmed_versions().items():
+        if key not in current:
+            invalidate_warmed(key)
+        elif versions - {current[key]}:
+            invalidate_warmed(key, keep_version=current[key])
+        else:
+            continue
+        affected += 1
+    return affected
 
-# No need to call this function once data is uploaded as it uploads kb data
-def store_documents():
-    # Loading KB Docs from notion_export folder
-    loader = NotionDirectoryLoader("notion_export/")
-    loaded_docs = loader.load()
 
-    # Chunking loaded docs
+def fixed_size_chunks(tagged_docs: list[Document]) -> list[Document]:
+    """Previous chunking: fixed 500-character chunks with 40 characters of overlap"""
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size = 500,
         chunk_overlap = 40,
         length_function=len
     )
+    return text_splitter.split_documents(tagged_docs)
 
-    docs = text_splitter.split_documents(loaded_docs)
+
+def _parent_id(doc: Document, part: int) -> str:
+    """Stable id of a parent section, so re-ingestion updates it in place"""
+    key = f"{doc.metadata.get('section', '')}::{doc.metadata.get('question', '')}::{part}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
+
+
+def _child_id(parent_id: str, index: int) -> str:
+    """Stable uuid of a child chunk, so re-ingestion overwrites it instead of adding a copy"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"kb-child:{parent_id}:{index}"))
+
+
+def parent_child_chunks(tagged_docs: list[Document]) -> tuple[list[Document], list[Document]]:
+    """Heading-aware chunking: each KB question is a parent section (split on paragraphs only if
+    longer than PARENT_MAX_CHARS), cut into small child chunks that point back to it"""
+    parent_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=PARENT_MAX_CHARS, chunk_overlap=0, separators=["\n\n", "\n", ". ", " "])
+    child_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHILD_CHUNK_SIZE, chunk_overlap=CHILD_CHUNK_OVERLAP)
+
+    parents, children = [], []
+    for doc in tagged_docs:
+        question = doc.metadata.get("question", "")
+        for part, text in enumerate(parent_splitter.split_text(doc.page_content)):
+            parent_id = _parent_id(doc, part)
+            parents.append(Document(id=parent_id, page_content=text,
+                                    metadata=dict(doc.metadata, chunk_type="section")))
+            for index, child in enumerate(child_splitter.split_text(text)):
+                # Children past the heading carry it, so a fragment still says what it is about
+                content = child if question in child else f"{question}\n{child}"
+                children.append(Document(id=_child_id(parent_id, index), page_content=content,
+                                         metadata=dict(doc.metadata, chunk_type="child", parent_id=parent_id)))
+    return parents, children
+
+
+def store_parent_sections(parents: list[Document], batch_size: int = 500):
+    """Upsert parent sections (sections that disappeared are pruned once the new children are in)"""
+    rows = [{"id": doc.id, "content": doc.page_content, "metadata": doc.metadata} for doc in parents]
+    for i in range(0, len(rows), batch_size):
+        supabase_client.table("kb_sections").upsert(rows[i:i + batch_size], on_conflict="id").execute()
+
+
+def table_ids(table: str) -> set:
+    """Every id in a table"""
+    ids, start, page = set(), 0, 1000
+    while True:
+        # PostgREST caps a response at 1000 rows
+        response = supabase_client.table(table).select("id").order("id").range(start, start + page - 1).execute()
+        rows = getattr(response, "data", None) or []
+        ids.update(str(row["id"]) for row in rows)
+        if len(rows) < page:
+            return ids
+        start += page
+
+
+def prune_rows(table: str, keep_ids: set, batch_size: int = 200) -> int:
+    """Delete every row whose id is not in keep_ids; returns the number deleted"""
+    stale = sorted(table_ids(table) - keep_ids)
+    for i in range(0, len(stale), batch_size):
+        supabase_client.table(table).delete().in_("id", stale[i:i + batch_size]).execute()
+    return len(stale)
+
+
+# No need to call this function once data is uploaded as it uploads kb data
+def store_documents(chunking: str = "sections"):
+    # Loading KB Docs from notion_export folder, tagging each question with its topic
+    # section so KB search can be narrowed to one partition
+    tagged_docs = load_kb_sections("notion_export/")
+
+    # Chunking tagged docs (chunks inherit the section metadata). "sections" embeds small
+    # children and stores whole sections for match_document_sections to return;
+    # "fixed" is the old 500/40 splitter (use with KB_PARENT_SECTIONS=false).
+    # New rows go in before old ones are deleted, so search never sees a section without children
+    if chunking == "sections":
+        parents, docs = parent_child_chunks(tagged_docs)
+        store_parent_sections(parents)
+        print(f"{len(parents)} sections, {len(docs)} child chunks")
+    else:
+        docs = fixed_size_chunks(tagged_docs)
 
     # Embedding
     embedding_model = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-mpnet-base-v2", 
+        model_name="sentence-transformers/all-mpnet-base-v2",
         model_kwargs={'device': 'cpu'},  # Use 'cuda' if you have GPU
         encode_kwargs={'normalize_embeddings': True}
     )
 
     # Store documents with embeddings
-    storing_doc = SupabaseVectorStore.from_documents(
-        docs,
-        embedding_model,
+    storing_doc = SupabaseVectorStore(
         client=supabase_client,
+        embedding=embedding_model,
         table_name="documents",
         query_name="match_documents",
         chunk_size=500  # Number of documents to insert at once
     )
-    
-    if storing_doc:
+    # Upserted, so children (stable ids) replace their previous version in place.
+    # from_documents would ignore the ids and always insert fresh rows
+    stored_ids = storing_doc.add_texts(
+        [doc.page_content for doc in docs],
+        [doc.metadata for doc in docs],
+        ids=[doc.id for doc in docs] if chunking == "sections" else None
+    )
+
+    if stored_ids:
         print("Data Successfully Uploaded")
-    
+        if chunking == "sections":
+            # Old children, children of removed sections and legacy fixed-size rows (no parent_id)
+            removed_chunks = prune_rows("documents", set(stored_ids))
+            removed_sections = prune_rows("kb_sections", {doc.id for doc in parents})
+            print(f"Removed {removed_chunks} old chunks and {removed_sections} old sections")
+        # Partial vector indexes for sections big enough to benefit from one
+        response = supabase_client.rpc("create_kb_section_indexes", {}).execute()
+        print(f"Section indexes: {getattr(response, 'data', None)}")
+        # Workers drop cached KB retrievals on their next version refresh
+        supabase_client.rpc("bump_retrieval_version", {"version_name": "kb"}).execute()
+        # Pre-warmed answers for changed questions are wrong now - warmup.py regenerates them
+        stale = invalidate_stale_warmup(tagged_docs)
+        if stale:
+            print(f"Invalidated warmed answers for {stale} changed KB questions")
+            supabase_client.rpc("bump_retrieval_version", {"version_name": "memory"}).execute()
+
     return storing_doc
 
 
 if __name__ == "__main__":
-    store_documents()
\ No newline at end of file
+    import sys
+    store_documents(sys.argv[1] if len(sys.argv) > 1 else "sections")
@@ -0,0 +1,501 @@
+"""
+Pre-fork production launcher for the BeWhoop Support Agent.
+
+    python server.py --workers 4 --port 8080
+
+The parent loads the embedding model and compiles the graph once, then forks a zygote before
+any thread exists; the zygote stays single-threaded and forks every worker (replacements too),
+so they all share those read-only pages copy-on-write and never inherit a half-held lock. The
+parent only runs the HTTP front end and routes each session to the same worker every time
+(session affinity); workers run the turns.
+
+    POST /chat    {"session_id": "...", "message": "..."}
+    GET  /health  per-worker liveness, served count, sessions, RSS/PSS and the worker's LLM
+                  cache, LLM limiter, resilience and retrieval cache stats
+    POST /reload  rolling restart of workers (also on SIGHUP), e.g. after a KB update -
+                  sessions are checkpointed and handed to the replacement worker
+    GET/POST /profiling  view or change turn profiling settings (see core/profiling.py);
+                  /chat takes an optional trace_id (or X-Trace-Id header) to profile one turn
+
+/reload and /profiling are admin routes: they need an X-Admin-Token header matching ADMIN_TOKEN,
+or - when ADMIN_TOKEN is unset - a request from localhost.
+"""
+import argparse, gc, hmac, ipaddress, itertools, json, os, signal, threading, time, zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.connection import Connection, Pipe
+from multiprocessing.reduction import send_handle, recv_handle
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Keep torch to one intra-op thread per process - workers give us the parallelism, and an
+# OpenMP pool started in the parent isn't safe to inherit across fork. Same for the HF
+# tokenizers' Rust thread pool.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+from core import (
+    ConversationState,
+    embeddings,
+    get_support_graph,
+    run_turn,
+    is_waiting_for_clarification,
+    reset_conversation,
+    bump_retrieval_version,
+    get_llm_cache_stats,
+    get_llm_limiter_stats,
+    get_resilience_stats,
+    get_retrieval_cache_stats,
+    get_profiling_settings,
+    write_profiling_control
+)
+
+MAX_CLARIFICATION_ATTEMPTS = 1
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "8"))
+MAX_SESSIONS_PER_WORKER = int(os.getenv("MAX_SESSIONS_PER_WORKER", "50000"))
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "60"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def memory_stats(pid: int) -> dict:
+    """RSS, PSS and private memory of a process in kB (Linux); PSS shows what CoW sharing saves"""
+    stats = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                    stats[key.lower()] = int(rest.split()[0])
+    except OSError:
+        return stats
+    stats["private"] = stats.pop("private_clean", 0) + stats.pop("private_dirty", 0)
+    return stats
+
+
+# =============================================================================
+# WORKER PROCESS
+# =============================================================================
+
+def _worker_main(conn, index: int, checkpoints: dict):
+    """Serve requests from the parent until told to stop"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # A terminal hangup reaches the whole process group - only the parent reloads on it
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    started_at = time.time()
+    sessions = OrderedDict(
+        (session_id, ConversationState.from_checkpoint(data)) for session_id, data in checkpoints.items()
+    )
+    session_locks = {}
+    locks_guard = threading.Lock()
+    send_lock = threading.Lock()
+    served = [0]
+
+    def session_lock(session_id: str) -> threading.Lock:
+        with locks_guard:
+            return session_locks.setdefault(session_id, threading.Lock())
+
+    def handle_turn(payload: dict) -> dict:
+        session_id = payload["session_id"]
+        # Turns of one session are serialized; different sessions run concurrently
+        with session_lock(session_id):
+            with locks_guard:
+                conversation = sessions.get(session_id) or ConversationState()
+                sessions[session_id] = conversation
+                sessions.move_to_end(session_id)
+                while len(sessions) > MAX_SESSIONS_PER_WORKER:
+                    evicted, _ = sessions.popitem(last=False)
+                    session_locks.pop(evicted, None)
+
+            is_clarification = is_waiting_for_clarification(conversation, MAX_CLARIFICATION_ATTEMPTS)
+            # Nobody to prompt for contact details over HTTP - escalation is reported, not collected
+            result = run_turn(payload["message"], is_clarification, conversation, interactive=False,
+                              trace_id=payload.get("trace_id"))
+            conversation = result["conversation"]
+            if conversation.escalation_needed or result.get("debug_info") == "escalation_required":
+                conversation = reset_conversation()
+            with locks_guard:
+                if session_id in sessions:
+                    sessions[session_id] = conversation
+            with locks_guard:
+                served[0] += 1
+            return {
+                "response": result["response"],
+                "agent_decision": result.get("agent_decision", ""),
+                "awaiting_clarification": is_waiting_for_clarification(conversation, MAX_CLARIFICATION_ATTEMPTS),
+                "worker": index,
+            }
+
+    def handle(req_id: int, op: str, payload):
+        try:
+            if op == "turn":
+                result = handle_turn(payload)
+            elif op == "ping":
+                # Every counter below is per process - /health is the only way to see them
+                result = {"pid": os.getpid(), "sessions": len(sessions), "served": served[0],
+                          "uptime_seconds": round(time.time() - started_at, 1),
+                          "llm_cache": get_llm_cache_stats(),
+                          "llm_limiter": get_llm_limiter_stats(),
+                          "resilience": get_resilience_stats(),
+                          "retrieval_cache": get_retrieval_cache_stats()}
+            elif op == "embed":
+                # Raw model forward pass, no caches - used by the scaling benchmark
+                result = len(embeddings.embed_query(payload))
+            else:
+                raise ValueError(f"Unknown op: {op}")
+            message = (req_id, True, result)
+        except Exception as e:
+            message = (req_id, False, str(e))
+        with send_lock:
+            conn.send(message)
+
+    executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix=f"worker{index}")
+    while True:
+        try:
+            req_id, op, payload = conn.recv()
+        except (EOFError, OSError):
+            break
+        if op == "stop":
+            # Finish in-flight turns, then hand our sessions back for the replacement worker
+            executor.shutdown(wait=True)
+            with send_lock:
+                conn.send((req_id, True, {sid: state.to_checkpoint() for sid, state in sessions.items()}))
+            break
+        if op == "ping":
+            # Answered here so health checks don't queue behind busy turn threads
+            handle(req_id, op, payload)
+            continue
+        executor.submit(handle, req_id, op, payload)
+    os._exit(0)
+
+
+def _zygote_main(conn):
+    """Fork a worker for each request from the parent. Forked before any thread was started
+    and never starts one, so workers forked later (restarts) are as clean as the first ones."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # Workers are reaped automatically; the parent sees a worker exit as EOF on its pipe
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            fd = recv_handle(conn)
+            index, checkpoints = conn.recv()
+        except (EOFError, OSError):
+            break
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            _worker_main(Connection(fd), index, checkpoints)
+        os.close(fd)
+        conn.send(pid)
+    os._exit(0)
+
+
+# =============================================================================
+# PARENT SIDE
+# =============================================================================
+
+class WorkerHandle:
+    """Parent-side view of one worker: its pipe, pending requests and drain state"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.pid = None
+        self.conn = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.accepting = threading.Event()
+        self.in_flight = 0
+        self.idle = threading.Condition(self.lock)
+        self.restarts = 0
+        self.started_at = 0.0
+        # Set when the worker's pipe closes - workers are the zygote's children, not ours
+        self.exited = threading.Event()
+
+    def _reader(self, conn, exited: threading.Event):
+        while True:
+            try:
+                req_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                waiter = self.pending.pop(req_id, None)
+            if waiter is not None:
+                waiter["ok"], waiter["result"] = ok, result
+                waiter["done"].set()
+        # Worker went away - fail whatever was still waiting on it
+        with self.lock:
+            waiters, self.pending = list(self.pending.values()), {}
+        for waiter in waiters:
+            waiter["ok"], waiter["result"] = False, "worker exited"
+            waiter["done"].set()
+        exited.set()
+
+
+class WorkerPool:
+    """Forks and supervises workers; routes requests with session affinity"""
+
+    def __init__(self, workers: int):
+        self.workers = [WorkerHandle(i) for i in range(workers)]
+        self._ids = itertools.count(1)
+        self._reload_lock = threading.Lock()
+        self._stopping = False
+        self._zygote_pid = None
+        self._zygote_conn = None
+        self._zygote_lock = threading.Lock()
+
+    def _start_zygote(self):
+        parent_conn, child_conn = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            _zygote_main(child_conn)
+        child_conn.close()
+        self._zygote_pid, self._zygote_conn = pid, parent_conn
+
+    def _spawn(self, worker: WorkerHandle, checkpoints: dict = None):
+        parent_conn, child_conn = Pipe()
+        try:
+            with self._zygote_lock:
+                # The zygote forks the worker around its end of the pipe
+                send_handle(self._zygote_conn, child_conn.fileno(), self._zygote_pid)
+                self._zygote_conn.send((worker.index, checkpoints or {}))
+                pid = self._zygote_conn.recv()
+        except (EOFError, OSError) as e:
+            parent_conn.close()
+            raise RuntimeError(f"zygote is gone, cannot start worker {worker.index}: {e}")
+        finally:
+            child_conn.close()
+        worker.pid, worker.conn, worker.started_at = pid, parent_conn, time.time()
+        worker.exited = threading.Event()
+        threading.Thread(target=worker._reader, args=(parent_conn, worker.exited), daemon=True).start()
+        worker.accepting.set()
+
+    def start(self):
+        # Everything the workers need is loaded here, before the first fork
+        get_support_graph()
+        embeddings.embed_query("warm up")
+        gc.collect()
+        # Keep the GC from writing to (and so un-sharing) every pre-fork object page
+        gc.freeze()
+        # Must be forked while this process is still single-threaded
+        self._start_zygote()
+        for worker in self.workers:
+            self._spawn(worker)
+        threading.Thread(target=self._supervise, daemon=True).start()
+
+    def route(self, session_id: str) -> WorkerHandle:
+        """Same session -> same worker, so its ConversationState lives in one place"""
+        return self.workers[zlib.crc32(session_id.encode("utf-8")) % len(self.workers)]
+
+    def _send(self, worker: WorkerHandle, op: str, payload, timeout: float):
+        waiter = {"done": threading.Event(), "ok": False, "result": None}
+        req_id = next(self._ids)
+        with worker.lock:
+            worker.pending[req_id] = waiter
+            worker.conn.send((req_id, op, payload))
+        if not waiter["done"].wait(timeout):
+            with worker.lock:
+                worker.pending.pop(req_id, None)
+            raise TimeoutError(f"worker {worker.index} did not answer within {timeout}s")
+        if not waiter["ok"]:
+            raise RuntimeError(waiter["result"])
+        return waiter["result"]
+
+    def submit(self, worker: WorkerHandle, op: str, payload, timeout: float = REQUEST_TIMEOUT_SECONDS):
+        """Send one request to a worker and wait for its result (waits out a reload of that worker)"""
+        if not worker.accepting.wait(timeout):
+            raise TimeoutError(f"worker {worker.index} is restarting")
+        with worker.lock:
+            worker.in_flight += 1
+        try:
+            return self._send(worker, op, payload, timeout)
+        finally:
+            with worker.lock:
+                worker.in_flight -= 1
+                worker.idle.notify_all()
+
+    def chat(self, session_id: str, message: str, trace_id: str = None) -> dict:
+        return self.submit(self.route(session_id), "turn",
+                           {"session_id": session_id, "message": message, "trace_id": trace_id})
+
+    def health(self) -> list:
+        report = []
+        for worker in self.workers:
+            entry = {"worker": worker.index, "pid": worker.pid, "restarts": worker.restarts,
+                     "accepting": worker.accepting.is_set(), "in_flight": worker.in_flight}
+            try:
+                start = time.monotonic()
+                entry.update(self._send(worker, "ping", None, timeout=5))
+                entry["ping_ms"] = round((time.monotonic() - start) * 1000, 1)
+                entry["alive"] = True
+            except Exception as e:
+                entry["alive"] = False
+                entry["error"] = str(e)
+            entry["memory_kb"] = memory_stats(worker.pid)
+            report.append(entry)
+        return report
+
+    def _restart(self, worker: WorkerHandle, graceful: bool = True):
+        worker.accepting.clear()
+        checkpoints = {}
+        if graceful:
+            with worker.lock:
+                while worker.in_flight:
+                    worker.idle.wait()
+            try:
+                checkpoints = self._send(worker, "stop", None, timeout=REQUEST_TIMEOUT_SECONDS)
+            except Exception as e:
+                print(f"Worker {worker.index} did not stop cleanly: {e}")
+                os.kill(worker.pid, signal.SIGKILL)
+        worker.exited.wait(REQUEST_TIMEOUT_SECONDS)
+        worker.conn.close()
+        worker.restarts += 1
+        self._spawn(worker, checkpoints)
+
+    def reload(self):
+        """Rolling restart - one worker at a time, sessions carried over, e.g. after a KB update"""
+        with self._reload_lock:
+            print("Reloading workers...")
+            # Other deployments' workers drop cached KB retrievals on their next version refresh
+            bump_retrieval_version("kb", wait=True)
+            for worker in self.workers:
+                self._restart(worker)
+            print("Reload complete")
+
+    def _supervise(self):
+        """Respawn workers that die unexpectedly (their sessions are lost)"""
+        while not self._stopping:
+            time.sleep(2)
+            for worker in self.workers:
+                if not worker.accepting.is_set() or self._stopping:
+                    continue
+                if worker.exited.is_set():
+                    print(f"Worker {worker.index} (pid {worker.pid}) died, respawning")
+                    with self._reload_lock:
+                        worker.accepting.clear()
+                        worker.conn.close()
+                        worker.restarts += 1
+                        try:
+                            self._spawn(worker)
+                        except RuntimeError as e:
+                            print(f"Error respawning worker {worker.index}: {e}")
+
+    def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            worker.accepting.clear()
+            try:
+                self._send(worker, "stop", None, timeout=10)
+            except Exception:
+                pass
+            worker.exited.wait(10)
+        # EOF on its pipe makes the zygote exit
+        self._zygote_conn.close()
+        try:
+            os.waitpid(self._zygote_pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def make_handler(pool: WorkerPool):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _admin_allowed(self) -> bool:
+            """Admin routes need the admin token, or come from localhost if none is configured"""
+            if ADMIN_TOKEN:
+                return hmac.compare_digest(self.headers.get("X-Admin-Token", "").encode("utf-8"),
+                                           ADMIN_TOKEN.encode("utf-8"))
+            try:
+                return ipaddress.ip_address(self.client_address[0]).is_loopback
+            except ValueError:
+                return False
+
+        def do_GET(self):
+            if self.path == "/health":
+                workers = pool.health()
+                self._reply(200 if all(w["alive"] for w in workers) else 503, {"workers": workers})
+            elif self.path == "/profiling":
+                if not self._admin_allowed():
+                    self._reply(403, {"error": "forbidden"})
+                    return
+                self._reply(200, get_profiling_settings())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path in ("/reload", "/profiling") and not self._admin_allowed():
+                self._reply(403, {"error": "forbidden"})
+                return
+            if self.path == "/reload":
+                threading.Thread(target=pool.reload, daemon=True).start()
+                self._reply(202, {"status": "reloading"})
+                return
+            if self.path == "/profiling":
+                # Written to the control file, so every worker picks it up within a second
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    self._reply(200, write_profiling_control(**body))
+                except (ValueError, TypeError) as e:
+                    self._reply(400, {"error": str(e)})
+                return
+            if self.path != "/chat":
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                session_id, message = str(body["session_id"]), str(body["message"]).strip()
+            except (ValueError, KeyError):
+                self._reply(400, {"error": "expected JSON with session_id and message"})
+                return
+            trace_id = body.get("trace_id") or self.headers.get("X-Trace-Id")
+            try:
+                self._reply(200, pool.chat(session_id, message, trace_id))
+            except TimeoutError as e:
+                self._reply(503, {"error": str(e)})
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-fork BeWhoop support server")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    pool = WorkerPool(args.workers)
+    # Fork before the HTTP server (and its threads) exist
+    pool.start()
+    # The zygote was forked before the listening socket existed, so no worker inherits it
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(pool))
+
+    signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=pool.reload, daemon=True).start())
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import os, sys, tempfile, types
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+# core/__init__ loads the embedding model and connects to Supabase on import. The modules
+# under test only need their siblings, so register the package without running __init__.
+if "core" not in sys.modules:
+    core = types.ModuleType("core")
+    core.__path__ = [os.path.join(ROOT, "core")]
+    sys.modules["core"] = core
+
+# Keep the module-level LLM cache out of the working tree
+os.environ.setdefault("LLM_CACHE_PATH", os.path.join(tempfile.mkdtemp(), "llm_cache.sqlite3"))
+# db/db.py builds its client on import; unit tests never reach the database
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.dGVzdA")
@@ -0,0 +1,78 @@
+from array import array
+import pytest
+
+# Drives the real graph - needs the full app environment (langgraph, embedding model, .env)
+pytest.importorskip("langgraph")
+pytest.importorskip("langchain_huggingface")
+
+from core import graph_nodes, memory, retrieval_cache
+from core.models import ConversationState
+from core.resilience import breakers
+from core.tools import is_waiting_for_clarification
+
+QUESTION = "how do I get paid"
+CLARIFICATION = "as a vendor"
+
+# A short fragment on its own isn't enough context (MIN_KB_CONTEXT_CHARS)...
+PAYOUTS = {"id": "payouts", "content": "Vendor payouts are sent every Friday to the linked bank account.",
+           "metadata": {"chunk_type": "child"}, "similarity": 0.6}
+# ...but together with the clarification's hit it is
+BANK = {"id": "bank", "content": "To link a bank account open Settings, choose Payments and add your details. " * 5,
+        "metadata": {"chunk_type": "child"}, "similarity": 0.5}
+
+
+@pytest.fixture
+def fake_turn(monkeypatch):
+    calls = {"embedded": [], "routed": [], "searches": [], "contexts": []}
+    vectors = {QUESTION: [1.0, 0.0, 0.0], CLARIFICATION: [0.8, 0.6, 0.0]}
+
+    def embed(text):
+        calls["embedded"].append(text)
+        return array("f", vectors[text])
+
+    def route(question, is_clarification, attempts, deadline=None):
+        calls["routed"].append(question)
+        return "need_kb_search"
+
+    def rpc(name, params):
+        calls["searches"].append(params)
+        return [PAYOUTS] if len(calls["searches"]) == 1 else [BANK]
+
+    def answer(question, context, deadline=None):
+        calls["contexts"].append(context)
+        return "Payouts go out every Friday."
+
+    monkeypatch.setattr(graph_nodes, "embed_query", embed)
+    monkeypatch.setattr(graph_nodes, "make_agent_decision", route)
+    monkeypatch.setattr(graph_nodes, "answer_with_llm", answer)
+    monkeypatch.setattr(graph_nodes, "semantic_memory_upsert", lambda *args, **kwargs: None)
+    monkeypatch.setattr(memory, "_rpc", rpc)
+    monkeypatch.setattr(memory, "classify_section", lambda query_vec: None)
+    monkeypatch.setattr(retrieval_cache, "RETRIEVAL_CACHE_ENABLED", False)
+    breakers["kb"].record_success()
+    return calls
+
+
+def test_clarification_reply_skips_routing_and_reranks_prior_candidates(fake_turn):
+    conversation = ConversationState()
+
+    first = graph_nodes.run_turn(QUESTION, False, conversation, interactive=False)
+    assert first["agent_decision"] == "need_kb_search"
+    assert is_waiting_for_clarification(conversation, graph_nodes.MAX_CLARIFICATION_ATTEMPTS)
+    assert conversation.query_embedding is not None
+    assert [ref.id for ref in conversation.kb_candidates] == ["kb:payouts"]
+
+    second = graph_nodes.run_turn(CLARIFICATION, True, conversation, interactive=False)
+    # Same intent, so the first attempt's routing is reused and only the new text is embedded
+    assert fake_turn["routed"] == [QUESTION]
+    assert fake_turn["embedded"] == [QUESTION, CLARIFICATION]
+    # The first attempt's candidate is reranked in with the new hit (decayed score)
+    kb_chunks = second["conversation"].kb_chunks
+    assert [ref.id for ref in kb_chunks] == ["kb:payouts", "kb:bank"]
+    assert kb_chunks[0].score == pytest.approx(PAYOUTS["similarity"] * memory.PRIOR_CANDIDATE_DECAY)
+    assert PAYOUTS["content"] in fake_turn["contexts"][0]
+    assert second["response"] == "Payouts go out every Friday."
+
+    # Answered - the next message is a new question again
+    assert not is_waiting_for_clarification(conversation, graph_nodes.MAX_CLARIFICATION_ATTEMPTS)
+    assert conversation.query_embedding is None and conversation.kb_candidates == []
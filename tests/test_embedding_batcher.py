@@ -0,0 +1,38 @@
+import threading
+from array import array
+from core.embedding_batcher import EmbeddingBatcher, EmbeddingCache
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text))] * 4 for text in texts]
+
+
+def test_cache_stores_float32_and_evicts_lru():
+    cache = EmbeddingCache(max_entries=2)
+    cache.set("a", [0.1] * 768)
+    vec = cache.get("a")
+    assert isinstance(vec, array) and vec.typecode == "f" and len(vec) == 768
+    cache.set("b", [0.2] * 768)
+    cache.get("a")
+    cache.set("c", [0.3] * 768)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_batcher_embeds_concurrent_texts_together():
+    fake = FakeEmbeddings()
+    batcher = EmbeddingBatcher(fake, max_batch=8, max_wait_seconds=0.2)
+    results = {}
+    threads = [threading.Thread(target=lambda t=text: results.__setitem__(t, batcher.embed(t)))
+               for text in ("x", "yy", "zzz")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert results == {"x": [1.0] * 4, "yy": [2.0] * 4, "zzz": [3.0] * 4}
+    assert len(fake.batches) == 1
@@ -0,0 +1,71 @@
+import threading, time
+import pytest
+from core.llm_cache import CachedLLM, LLMCache
+from core.llm_limiter import AdaptiveLimiter, LLMOverloadedError, SingleFlight
+from core.resilience import Deadline, DeadlineExceededError, breakers
+
+
+class Response:
+    def __init__(self, content):
+        self.content = content
+
+
+class SlowLLM:
+    model = "test-model"
+    temperature = 0
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.finished = threading.Event()
+
+    def invoke(self, prompt):
+        time.sleep(self.seconds)
+        self.finished.set()
+        return Response(f"answer to {prompt}")
+
+
+@pytest.fixture
+def limiter():
+    return AdaptiveLimiter(initial=1, minimum=1, maximum=1, max_queue=0, max_wait=0.01)
+
+
+@pytest.fixture(autouse=True)
+def closed_llm_breaker():
+    breakers["llm"].record_success()
+    yield
+    breakers["llm"].record_success()
+
+
+def _cached_llm(llm, limiter, tmp_path):
+    return CachedLLM(llm, cache=LLMCache(str(tmp_path / "cache.sqlite3")), limiter=limiter,
+                     single_flight=SingleFlight())
+
+
+def test_slot_held_until_timed_out_call_finishes(limiter, tmp_path):
+    slow = SlowLLM(0.3)
+    client = _cached_llm(slow, limiter, tmp_path)
+    with pytest.raises(DeadlineExceededError):
+        client.invoke("first", use_cache=False, deadline=Deadline(0.05))
+    # Gemini is still working on the first call, so the only slot is still taken
+    assert limiter.get_stats()["in_flight"] == 1
+    with pytest.raises(LLMOverloadedError):
+        client.invoke("second", use_cache=False, deadline=Deadline(5))
+    assert slow.finished.wait(1)
+    time.sleep(0.02)
+    assert limiter.get_stats()["in_flight"] == 0
+
+
+def test_successful_call_releases_slot_and_caches(limiter, tmp_path):
+    client = _cached_llm(SlowLLM(0), limiter, tmp_path)
+    assert client.invoke("hello", deadline=Deadline(5)) == "answer to hello"
+    time.sleep(0.02)
+    assert limiter.get_stats()["in_flight"] == 0
+    assert client.invoke("hello", deadline=Deadline(5)) == "answer to hello"
+    assert limiter.get_stats()["acquired"] == 1
+
+
+def test_spent_budget_never_takes_a_slot(limiter, tmp_path):
+    client = _cached_llm(SlowLLM(0), limiter, tmp_path)
+    with pytest.raises(DeadlineExceededError):
+        client.invoke("late", use_cache=False, deadline=Deadline(0))
+    assert limiter.get_stats()["in_flight"] == 0
@@ -0,0 +1,54 @@
+import json, os
+import pytest
+from core import profiling
+
+
+@pytest.fixture
+def control_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "profiling.json")
+    monkeypatch.setattr(profiling, "PROFILE_CONTROL_FILE", path)
+    saved = dict(profiling._settings)
+    yield path
+    profiling._settings.update(saved)
+
+
+def test_numbers_are_converted(control_file):
+    settings = profiling.write_control_file(sample_rate="0.25", interval_ms=10)
+    assert settings["sample_rate"] == 0.25 and settings["interval_ms"] == 10.0
+    with open(control_file) as f:
+        assert json.load(f)["sample_rate"] == 0.25
+
+
+@pytest.mark.parametrize("changes", [
+    {"sample_rate": "often"},
+    {"sample_rate": 2},
+    {"sample_rate": True},
+    {"interval_ms": 0},
+    {"interval_ms": float("nan")},
+    {"trace_ids": "abc"},
+    {"trace_ids": ["abc", 1]},
+    {"allocations": "yes"},
+    {"unknown": 1},
+])
+def test_invalid_settings_are_rejected(control_file, changes):
+    with pytest.raises(ValueError):
+        profiling.write_control_file(**changes)
+    with pytest.raises(ValueError):
+        profiling.configure(**changes)
+    assert not os.path.exists(control_file)
+
+
+def test_invalid_stored_settings_are_dropped(control_file):
+    with open(control_file, "w") as f:
+        json.dump({"sample_rate": "x", "trace_ids": ["abc"]}, f)
+    assert profiling.write_control_file(interval_ms=5) == {"trace_ids": ["abc"], "interval_ms": 5.0}
+
+
+def test_profile_file_names_are_sanitized(tmp_path):
+    profile = profiling.TurnProfile("../../etc/x y", allocations=False)
+    profile.decision = "need kb/search\n"
+    profile.start()
+    profile.stop()
+    prefix = profile.write(str(tmp_path))
+    assert os.path.dirname(prefix) == str(tmp_path)
+    assert os.path.basename(prefix).endswith("-need_kb_search_-______etc_x_y")
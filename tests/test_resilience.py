@@ -0,0 +1,175 @@
+import threading, time
+import pytest
+from core import resilience
+from core.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    DeadlineExceededError,
+    call_with_timeout,
+    hedged_call,
+)
+
+
+def _count(name):
+    return resilience.get_resilience_stats()[name]
+
+
+# Deadline
+
+def test_deadline_timeout_is_capped_by_remaining_budget():
+    deadline = Deadline(10)
+    assert 9 < deadline.remaining() <= 10
+    assert deadline.timeout(cap=2) == 2
+    assert deadline.timeout() <= 10
+
+
+def test_spent_deadline_raises_and_counts_budget_exhausted():
+    deadline = Deadline(0)
+    before = _count("budget_exhausted")
+    assert deadline.expired()
+    with pytest.raises(DeadlineExceededError):
+        deadline.timeout()
+    assert deadline.spent()
+    assert _count("budget_exhausted") == before + 2
+
+
+def test_live_deadline_is_not_spent():
+    before = _count("budget_exhausted")
+    assert not Deadline(10).spent()
+    assert _count("budget_exhausted") == before
+
+
+# CircuitBreaker
+
+def test_breaker_opens_after_threshold_and_skips():
+    breaker = CircuitBreaker("test-open", failure_threshold=2, reset_seconds=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_breaker_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker("test-half-open", failure_threshold=1, reset_seconds=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_breaker_abandoned_trial_is_retried_after_cool_down():
+    breaker = CircuitBreaker("test-abandoned", failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    # The trial's caller raised before recording a result
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_breaker_failed_trial_reopens():
+    breaker = CircuitBreaker("test-reopen", failure_threshold=3, reset_seconds=0.01)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = CircuitBreaker("test-reset", failure_threshold=2, reset_seconds=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+# call_with_timeout / hedged_call
+
+def test_call_with_timeout_cancels_queued_work(monkeypatch):
+    monkeypatch.setitem(resilience.POOL_THREADS, "test-queue", 1)
+    release = threading.Event()
+    ran = []
+    blocker = threading.Thread(
+        target=lambda: call_with_timeout("test-queue", release.wait, Deadline(5), 5), daemon=True)
+    blocker.start()
+    time.sleep(0.05)
+    # The only thread is busy, so this call is still queued when it times out
+    with pytest.raises(DeadlineExceededError):
+        call_with_timeout("test-queue", lambda: ran.append(1), Deadline(5), cap=0.05)
+    release.set()
+    blocker.join(1)
+    time.sleep(0.05)
+    assert ran == []
+
+
+def test_slow_dependency_does_not_starve_another(monkeypatch):
+    monkeypatch.setitem(resilience.POOL_THREADS, "test-slow", 1)
+    release = threading.Event()
+    blockers = [threading.Thread(target=lambda: call_with_timeout("test-slow", release.wait, Deadline(5), 5),
+                                 daemon=True) for _ in range(3)]
+    for blocker in blockers:
+        blocker.start()
+    try:
+        assert call_with_timeout("test-fast", lambda: "ok", Deadline(5), cap=1) == "ok"
+    finally:
+        release.set()
+
+
+def test_on_done_runs_when_call_finishes_after_timeout():
+    finished = threading.Event()
+    with pytest.raises(DeadlineExceededError):
+        call_with_timeout("test-on-done", time.sleep, Deadline(5), 0.1, cap=0.01,
+                          on_done=lambda future: finished.set())
+    assert not finished.is_set()
+    assert finished.wait(1)
+
+
+def test_hedged_call_returns_result_and_propagates_errors():
+    assert hedged_call("test-hedge-plain", lambda x: x * 2, Deadline(5), 21) == 42
+
+    def fail():
+        raise ValueError("boom")
+    with pytest.raises(ValueError):
+        hedged_call("test-hedge-plain", fail, Deadline(5))
+
+
+def test_hedged_call_times_out():
+    before = _count("timeouts").get("test-hedge-timeout", 0)
+    with pytest.raises(DeadlineExceededError):
+        hedged_call("test-hedge-timeout", time.sleep, Deadline(0.05), 0.5)
+    assert _count("timeouts")["test-hedge-timeout"] == before + 1
+
+
+def test_hedge_fires_past_p95_and_can_win(monkeypatch):
+    dependency = "test-hedge-win"
+    monkeypatch.setattr(resilience, "HEDGE_MIN_DELAY_SECONDS", 0.01)
+    for _ in range(resilience.HEDGE_MIN_SAMPLES):
+        resilience._tracker(dependency).record(0.01)
+    calls = []
+
+    def slow_first():
+        calls.append(1)
+        # The primary stalls; the hedge returns at once
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return "primary"
+        return "hedge"
+
+    fired, wins = _count("hedges_fired"), _count("hedge_wins")
+    assert hedged_call(dependency, slow_first, Deadline(5)) == "hedge"
+    assert _count("hedges_fired") == fired + 1
+    assert _count("hedge_wins") == wins + 1
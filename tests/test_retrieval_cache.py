@@ -0,0 +1,41 @@
+import pytest
+from core import retrieval_cache as rc
+from core.models import Answer, ChunkRef
+
+
+class Versions:
+    """In-process stand-in for the shared version counters"""
+
+    def __init__(self):
+        self.epoch = {"kb": 0, "memory": 0}
+
+    def current(self, kind):
+        return 0, self.epoch[kind]
+
+    def bump(self, kind):
+        self.epoch[kind] += 1
+
+
+QUERY = [1.0] + [0.0] * (rc.EMBEDDING_DIMENSIONS - 1)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(rc, "RETRIEVAL_CACHE_ENABLED", True)
+    return rc.RetrievalCache(Versions())
+
+
+def test_hit_for_the_same_version(cache):
+    found = Answer(found=True, chunks=[ChunkRef("kb:1", 0.9)])
+    cache.set("kb", "sig", QUERY, found, cache.version("kb"))
+    assert cache.get("kb", "sig", QUERY) is found
+    assert cache.get("memory", "sig", QUERY) is None
+
+
+def test_result_of_a_lookup_that_overlapped_a_bump_is_not_served(cache):
+    version = cache.version("memory")
+    # An upsert lands while the lookup RPC is still running
+    cache.versions.bump("memory")
+    cache.set("memory", "sig", QUERY, Answer(found=False, chunks=[]), version)
+    assert cache.get("memory", "sig", QUERY) is None
+    assert cache.get_stats()["memory"]["stale"] == 1
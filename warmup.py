@@ -0,0 +1,117 @@
+"""
+Offline FAQ pre-warming of qa_memory from the knowledge base.
+
+    python warmup.py --variants 5
+
+For every KB question in notion_export/, asks the LLM for likely ways a user would phrase
+it, answers each with answer_with_llm against that question's KB text, and upserts the pairs
+into qa_memory tagged with the KB version (a hash of the source text). Sections whose text is
+unchanged since the last run are skipped. A changed section's new answers are written before
+its old ones are deleted, so a failed run never leaves it with none. Ingestion (loader.py)
+separately deletes warmed answers whose KB text has changed.
+"""
+import argparse, re
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from langchain_core.prompts import ChatPromptTemplate
+from db.db import supabase_client
+from core.tools import llm, answer_with_llm
+from core.memory import semantic_memory_upsert_many
+from core.retrieval_cache import bump_retrieval_version
+from loader import load_kb_sections, kb_key, kb_version, warmed_versions, invalidate_warmed, WARMUP_SOURCE
+
+load_dotenv()
+
+
+def generate_question_variants(doc, count: int, use_cache: bool = True) -> list[str]:
+    """Ask the LLM how users are likely to phrase questions this KB entry answers"""
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", """You write realistic customer support questions for BeWhoop, a social platform connecting vendors, event organizers and event seekers.
+        Given one knowledge base entry, write {count} different questions a real user might type that this entry answers.
+        Vary the wording and length, use first person where natural, and keep each on its own line with no numbering."""),
+        ("human", "Knowledge base entry:\n{entry}")
+    ])
+    response = llm.invoke(prompt.invoke({"count": count, "entry": doc.page_content}), use_cache=use_cache)
+    variants = []
+    for line in response.splitlines():
+        # Strip any numbering/bullets the model adds anyway
+        question = re.sub(r"^\s*(\d+[.)]|[-*•])\s*", "", line).strip()
+        if question and question not in variants:
+            variants.append(question)
+    # The KB heading itself is the most likely question of all
+    heading = doc.metadata.get("question")
+    if heading and heading not in variants:
+        variants.insert(0, heading)
+    return variants[:count + 1]
+
+
+def replace_warmed(key: str, questions: list[str]):
+    """Delete a KB question's warmed answers other than the ones just written"""
+    if not questions:
+        invalidate_warmed(key)
+        return
+    (supabase_client.table("qa_memory").delete().eq("source", WARMUP_SOURCE).eq("kb_key", key)
+     .not_.in_("question", questions).execute())
+
+
+def warm_section(doc, variants: int, use_cache: bool = True) -> list[dict]:
+    """Generate and answer likely questions for one KB question"""
+    context = f"From Knowledge Base: {doc.page_content}"
+    rows = []
+    for question in generate_question_variants(doc, variants, use_cache):
+        answer = answer_with_llm(question, context, use_cache=use_cache)
+        if answer == "CANNOT_ANSWER_WITH_CONTEXT":
+            continue
+        rows.append({
+            "question": question,
+            "answer": answer,
+            "source": WARMUP_SOURCE,
+            "kb_key": kb_key(doc),
+            "kb_version": kb_version(doc),
+        })
+    return rows
+
+
+def warm_up(path: str = "notion_export/", variants: int = 5, concurrency: int = 4, force: bool = False) -> dict:
+    """Pre-warm qa_memory for every new or changed KB question"""
+    docs = load_kb_sections(path)
+    existing = warmed_versions()
+
+    stale = [doc for doc in docs if force or existing.get(kb_key(doc)) != {kb_version(doc)}]
+    print(f"{len(stale)} of {len(docs)} KB questions need warming")
+
+    def warm(doc) -> int:
+        written = 0
+        try:
+            # --force means new variants and answers, not the LLM cache's copies of the old ones
+            rows = warm_section(doc, variants, use_cache=not force)
+            written = semantic_memory_upsert_many(rows)
+            # New answers are in, so the old ones can go
+            replace_warmed(kb_key(doc), [row["question"] for row in rows])
+        except Exception as e:
+            # Old answers stay in place until a later run replaces them; the rest of the run goes on
+            print(f"Error warming {kb_key(doc)}: {e}")
+        return written
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        written = sum(executor.map(warm, stale))
+
+    # KB questions that were removed from the export entirely
+    for key in set(existing) - {kb_key(doc) for doc in docs}:
+        try:
+            invalidate_warmed(key)
+        except Exception as e:
+            print(f"Error removing warmed answers for {key}: {e}")
+    bump_retrieval_version("memory", wait=True)
+    print(f"Warmed {written} question/answer pairs")
+    return {"kb_questions": len(docs), "warmed_sections": len(stale), "rows": written}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-warm qa_memory from the knowledge base")
+    parser.add_argument("--path", default="notion_export/")
+    parser.add_argument("--variants", type=int, default=5, help="Generated questions per KB question")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="Regenerate even unchanged sections")
+    args = parser.parse_args()
+    warm_up(args.path, args.variants, args.concurrency, args.force)